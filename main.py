@@ -1,10 +1,16 @@
 import src.data_gen as dg
 import src.score as sc
-import src.viz as viz
+import src.store as store
+from src.metrics import Metrics, maybe_stage
+from src.game import GameConfig, DEFAULT_GAME
+from src.aggregate import Aggregate, load_aggregate
 import json
-import math
-import time
 import os
+import sys
+import argparse
+
+# src.viz (matplotlib, seaborn, pandas) and src.exact are imported by the
+# stages that use them, so generation and scoring processes never load them
 
 # --- Configuration ---
 TOTAL_DECKS = 2_000_000
@@ -12,49 +18,185 @@ BATCH_SIZE = 10_000
 RAW_DATA_DIR = './raw_data'
 RESULTS_DIR = './results'
 SEED = 12345
+WORKERS = None          # generation/scoring processes, None = cpu_count()
+CHUNK_DECKS = 10_000    # decks per scoring task
+PROGRESS = True         # live per-chunk progress line while scoring
+PROFILE_DIR = None      # set to a directory to cProfile every scoring worker
+PREFETCH = sc.PREFETCH_DEPTH  # chunks each scoring worker loads ahead while it scores, 0 = off
+SYMMETRY = None         # None, 'half' (half the work) or 'double' (twice the samples), see score.apply_symmetry
+ORBIT_CHECK = False     # print the measured within-orbit differences of the color-complement symmetry
+RULES = sc.DEFAULT_RULES  # scoring rules evaluated in one pass, one CSV each, see score.SCORING_RULES
+RESUME = False          # pick up an interrupted full or --stream run where it stopped
+SEQ_LEN = 3             # cards per player sequence
+N_COLORS = 2            # card colors
+CARDS_PER_COLOR = 26    # cards of each color per deck
+SHOE_DECKS = 1          # decks shuffled together into one shoe
 # -------------------
 
+def scoring_options(metrics: Metrics) -> dict:
+    '''
+    Keyword options shared by all score.run_* calls
+    '''
+    return {'workers': WORKERS, 'metrics': metrics, 'progress': PROGRESS, 'profile_dir': PROFILE_DIR,
+            'prefetch': PREFETCH}
+
+def symmetry_options() -> dict:
+    '''
+    Color-complement symmetry and scoring-rule options of the sampling runs
+    '''
+    return {'symmetry': SYMMETRY, 'orbit_check': ORBIT_CHECK, 'rules': RULES}
+
+def game_config() -> GameConfig:
+    '''
+    The game being simulated. The raw data pipeline (store, batch files,
+    incremental scoring) holds standard-game decks; other games are sampled
+    in memory with --stream or --target-ci.
+    '''
+    return GameConfig(seq_len=SEQ_LEN, n_colors=N_COLORS, cards_per_color=CARDS_PER_COLOR, n_decks=SHOE_DECKS)
+
+def save_metrics(metrics: Metrics):
+    '''
+    Writes the run's metrics next to scoring_results.csv
+    '''
+    metrics.save(os.path.join(RESULTS_DIR, 'metrics.json'))
+
+
 def augment_data(n: int):
     '''
     Generates n new decks, and automatically updates scores and figures.
     '''
     print(f'--- Augmenting data with {n} new decks ---')
+    metrics = Metrics('augment')
 
-    # 1. Data Generation
-    dg.ensure_dir(RAW_DATA_DIR)
-    n_batches = math.ceil(n / BATCH_SIZE)
-    prod = 0
-
-    # Find the next available batch index
-    raw_files = [f for f in os.listdir(RAW_DATA_DIR) if f.endswith('.npz')]
-    next_batch_idx = len(raw_files)
-
-    for b in range(n_batches):
-        this_size = min(BATCH_SIZE, n - prod)
-        batch_idx = next_batch_idx + b
-        dg.simulate_batch(
-            batch_idx=batch_idx,
-            batch_size=this_size,
-            out_dir=RAW_DATA_DIR,
-            seed=SEED + batch_idx # Use a new seed for each batch
-        )
-        prod += this_size
-
-    print(f'--- {n} new decks generated in {n_batches} batches ---')
-
-    # 2. Scoring
-    print('\n--- Re-running Scoring ---')
-    output_csv_path = os.path.join(RESULTS_DIR, 'scoring_results.csv')
-    total_decks = sc.run_simulation(RAW_DATA_DIR, output_csv_path)
+    # 1. Data Generation (appended to the deck store)
+    entries = generate_data(metrics, n, append=True)
+    print(f'--- {n} new decks generated in {len(entries)} batches ---')
+
+    # 2. Scoring (only batches without an up-to-date partial aggregate)
+    print('\n--- Updating Scores ---')
+    output_csv_path, total_decks, n_scored, results = score_data(metrics)
+    if n_scored == 0:
+        print('--- Nothing changed, skipping visualizations ---')
+        save_metrics(metrics)
+        return
     print('--- Scoring Complete ---')
 
     # 3. Visualization
     print('\n--- Re-generating Visualizations ---')
-    viz.run_visualization(csv_path=output_csv_path, outdir=RESULTS_DIR, total_decks=total_decks)
+    render_results(output_csv_path, total_decks, metrics, results=results)
     print('--- Visualizations Complete ---')
+    save_metrics(metrics)
 
 
-import argparse
+def run_state_path() -> str:
+    '''
+    Parameters of the current full run, kept next to the deck store so
+    --resume can check that it continues the same run
+    '''
+    return os.path.join(RAW_DATA_DIR, 'run_state.json')
+
+def resumable_run() -> bool:
+    '''
+    True if the deck store belongs to an interrupted full run with the
+    current TOTAL_DECKS, BATCH_SIZE and SEED
+    '''
+    if not os.path.exists(run_state_path()):
+        return False
+    with open(run_state_path()) as f:
+        state = json.load(f)
+    return state == {'total_decks': TOTAL_DECKS, 'batch_size': BATCH_SIZE, 'seed': SEED,
+                     'store_id': store.load_index(RAW_DATA_DIR)['store_id']}
+
+def generate_data(metrics: Metrics, n_decks: int, append: bool = False) -> list[dict]:
+    '''
+    Generates n_decks decks into the deck store in RAW_DATA_DIR.
+
+    A new run replaces the store and records its parameters in
+    run_state.json; with RESUME an interrupted run with the same parameters
+    continues instead. With append the decks are added to the existing store.
+    A new run refuses to start next to loose batch files of an older run,
+    which scoring would otherwise count together with the new store.
+    '''
+    dg.ensure_dir(RAW_DATA_DIR)
+    perf_path = os.path.join(RAW_DATA_DIR, 'perf_results.json')
+    loose = dg.list_batch_files(RAW_DATA_DIR)
+    if loose and not append:
+        raise SystemExit(f'{RAW_DATA_DIR} holds {len(loose)} batch files of an older run; a new run would score them '
+                         f'together with the new decks. Run `main.py migrate-store` to keep them (then use `augment` '
+                         f'or `generate --append`), or move them out of {RAW_DATA_DIR}.')
+    resume = RESUME and not append and resumable_run()
+    if RESUME and not append and not resume:
+        print('No interrupted run with these parameters to resume, starting a new one.')
+    with metrics.stage('generation'):
+        if append:
+            entries = dg.generate_to_store(RAW_DATA_DIR, n_decks, BATCH_SIZE, seed=SEED,
+                                           first_batch_idx=dg.next_batch_index(RAW_DATA_DIR), workers=WORKERS)
+        else:
+            if not resume:
+                index = store.create_store(RAW_DATA_DIR)
+                if os.path.exists(perf_path):
+                    os.remove(perf_path)  # timings of an older run, see below
+                sc.write_json_atomic(run_state_path(), {'total_decks': n_decks, 'batch_size': BATCH_SIZE,
+                                                        'seed': SEED, 'store_id': index['store_id']})
+            entries = dg.generate_to_store(RAW_DATA_DIR, n_decks, BATCH_SIZE, seed=SEED, workers=WORKERS,
+                                           resume=resume)
+    metrics.add('generation', decks=sum(e['count'] for e in entries), batches=len(entries),
+                worker_s=sum(e['gen_time_s'] for e in entries))
+
+    if not append:
+        rows = {e['batch_idx']: (e['gen_time_s'], e['count'] * store.STORE_DTYPE.itemsize / (1024**2)) for e in entries}
+        if resume and os.path.exists(perf_path):
+            # a resumed run only generates the missing batches: keep the timings already recorded
+            with open(perf_path) as f:
+                old = json.load(f)
+            for b, t, mb in zip(old['batch_idx'], old['gen_write_time_s'], old['file_mb']):
+                rows.setdefault(b, (t, mb))
+        order = sorted(rows)
+        gen_results = {
+            'batch_idx': order,
+            'gen_write_time_s': [rows[b][0] for b in order],
+            'file_mb': [rows[b][1] for b in order],
+        }
+        with open(perf_path, 'w') as f:
+            json.dump(gen_results, f, indent=2)
+
+    print(f'Successfully generated {sum(e["count"] for e in entries)} decks in {len(entries)} batches.')
+    return entries
+
+def score_data(metrics: Metrics) -> tuple[str, int, int, Aggregate | None]:
+    '''
+    Scores the decks in RAW_DATA_DIR (only batches without an up-to-date
+    partial aggregate). Returns (CSV path, total decks, decks scored now,
+    aggregate of the CSV).
+    '''
+    dg.ensure_dir(RESULTS_DIR)
+    output_csv_path = os.path.join(RESULTS_DIR, 'scoring_results.csv')
+    with metrics.stage('scoring'):
+        total_decks, n_scored, results = sc.run_incremental(RAW_DATA_DIR, output_csv_path, chunk_decks=CHUNK_DECKS,
+                                                              **scoring_options(metrics), **symmetry_options())
+    metrics.add('scoring', decks=total_decks)
+    return output_csv_path, total_decks, n_scored, results
+
+def render_results(csv_path: str, total_decks: int | None = None, metrics: Metrics | None = None, force: bool = False,
+                   results: Aggregate | None = None):
+    '''
+    Creates the heatmaps of a scoring CSV in RESULTS_DIR from results, the
+    aggregate the scoring run just wrote, or else the aggregate read once
+    from disk. total_decks defaults to the deck count of the aggregate.
+    Heatmaps whose inputs did not change since they were drawn are kept
+    unless force.
+    '''
+    import src.viz as viz
+    with maybe_stage(metrics, 'visualization'):
+        if results is None:
+            if not os.path.exists(csv_path):
+                print(f'Error: CSV file not found at {csv_path}')
+                return
+            with maybe_stage(metrics, 'visualization/read_csv'):
+                results = load_aggregate(csv_path)
+        if total_decks is None:
+            total_decks = int(results['decks'].max())
+        viz.render_aggregate(results, RESULTS_DIR, total_decks, metrics, force=force)
 
 def run_full_process():
     '''
@@ -63,52 +205,294 @@ def run_full_process():
     1. Generates simulated card deck data.
     2. Runs the scoring simulation on the generated data.
     3. Creates and saves heatmap visualizations of the results.
+
+    Both steps checkpoint as they go: generated batches are committed to the
+    store index in groups, and every scored batch saves its partial
+    aggregate. With RESUME (--resume), an interrupted run with the same
+    parameters continues from there instead of starting over.
     '''
     # --- 1. Data Generation ---
     print('--- Step 1: Generating Data ---')
-    dg.ensure_dir(RAW_DATA_DIR)
-    n_batches = math.ceil(TOTAL_DECKS / BATCH_SIZE)
-    prod = 0
+    metrics = Metrics('full')
+    generate_data(metrics, TOTAL_DECKS)
 
-    gen_results = {'batch_idx': [], 'gen_write_time_s': [], 'file_mb': []}
+    # --- 2. Scoring ---
+    print('\n--- Step 2: Running Scoring Simulation ---')
+    output_csv_path, total_decks, _, results = score_data(metrics)
 
-    for b in range(n_batches):
-        this_size = min(BATCH_SIZE, TOTAL_DECKS - prod)
-        t0 = time.perf_counter()
-        path = dg.simulate_batch(b, this_size, RAW_DATA_DIR, seed=SEED + b)
-        t1 = time.perf_counter()
-        size_mb = os.path.getsize(path) / (1024**2)
+    # --- 3. Visualization ---
+    print('\n--- Step 3: Generating Visualizations ---')
+    render_results(output_csv_path, total_decks, metrics, results=results)
 
-        gen_results['batch_idx'].append(b)
-        gen_results['gen_write_time_s'].append(t1 - t0)
-        gen_results['file_mb'].append(size_mb)
+    save_metrics(metrics)
+    print('\n--- Pipeline Finished ---')
 
-        prod += this_size
+def run_stream_process(n: int, render: bool = True, first_deck: int | None = None):
+    '''
+    Estimation-only pipeline: generates and scores n decks in memory, without
+    writing raw deck files, then creates the heatmaps (unless render is False).
+    With first_deck, the decks are first_deck..first_deck+n-1 of the
+    counter-based deck space of SEED (see data_gen.generate_deck_range).
+    '''
+    print(f'--- Streaming {n} decks (generate + score, no raw files) ---')
+    metrics = Metrics('stream')
+    dg.ensure_dir(RESULTS_DIR)
+    output_csv_path = os.path.join(RESULTS_DIR, 'scoring_results.csv')
+    with metrics.stage('scoring'):
+        total_decks, results = sc.run_streaming(n, output_csv_path, batch_size=BATCH_SIZE, seed=SEED, game=game_config(),
+                                                checkpoint_path=os.path.join(RESULTS_DIR, 'stream_checkpoint.json'),
+                                                resume=RESUME, first_deck=first_deck, **scoring_options(metrics),
+                                                **symmetry_options())
+    metrics.add('scoring', decks=total_decks)
 
-    with open(os.path.join(RAW_DATA_DIR, 'perf_results.json'), 'w') as f:
-        json.dump(gen_results, f, indent=2)
-    
-    print(f'Successfully generated {TOTAL_DECKS} decks in {n_batches} batches.')
+    if render:
+        print('\n--- Generating Visualizations ---')
+        render_results(output_csv_path, total_decks, metrics, results=results)
+    save_metrics(metrics)
 
-    # --- 2. Scoring ---
-    print('\n--- Step 2: Running Scoring Simulation ---')
+def run_converge_process(target_ci: float, max_decks: int | None = None, render: bool = True):
+    '''
+    Convergence-driven pipeline: generates and scores decks in memory until
+    every win/tie rate's 95% interval is within +/- target_ci, then creates
+    the heatmaps (annotated with the intervals) unless render is False.
+    '''
+    print(f'--- Sampling until every 95% CI is within +/-{target_ci} ---')
+    metrics = Metrics('converge')
     dg.ensure_dir(RESULTS_DIR)
     output_csv_path = os.path.join(RESULTS_DIR, 'scoring_results.csv')
-    total_decks = sc.run_simulation(RAW_DATA_DIR, output_csv_path)
+    with metrics.stage('scoring'):
+        total_decks, results = sc.run_until_converged(target_ci, output_csv_path, batch_size=BATCH_SIZE, seed=SEED,
+                                                      max_decks=max_decks, game=game_config(), **scoring_options(metrics))
+    metrics.add('scoring', decks=total_decks, target_ci=target_ci)
 
-    # --- 3. Visualization ---
-    print('\n--- Step 3: Generating Visualizations ---')
-    viz.run_visualization(csv_path=output_csv_path, outdir=RESULTS_DIR, total_decks=total_decks)
+    if render:
+        print('\n--- Generating Visualizations ---')
+        render_results(output_csv_path, total_decks, metrics, results=results)
+    save_metrics(metrics)
 
-    print('\n--- Pipeline Finished ---')
+def run_exact_process():
+    '''
+    Computes exact win/tie probabilities for all pairs (no sampling) and saves
+    them with the same schema as the sampled scoring CSV.
+    '''
+    import src.exact as ex
+    print('--- Computing Exact Probabilities ---')
+    dg.ensure_dir(RESULTS_DIR)
+    ex.run_exact(os.path.join(RESULTS_DIR, 'exact_results.csv'))
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Run the card game simulation pipeline.")
-    parser.add_argument('--augment', type=int, metavar='N', help='Generate N new decks and update scores and figures.')
+def report_exact_error(sampled_csv_path: str):
+    '''
+    Prints how far a sampled scoring CSV is from the exact probabilities.
+    '''
+    import src.exact as ex
+    dg.ensure_dir(RESULTS_DIR)
+    cmp = ex.compare_to_exact(sampled_csv_path, os.path.join(RESULTS_DIR, 'exact_results.csv'))
+    worst = cmp.reindex(cmp['z'].abs().sort_values(ascending=False).index).head(5)
+
+    print(f'--- Sampled vs Exact: {sampled_csv_path} ---')
+    print(f'Max absolute error: {cmp["abs_error"].max():.6f}')
+    print(f'Mean absolute error: {cmp["abs_error"].mean():.6f}')
+    print(f'Max |z|: {cmp["z"].abs().max():.2f}')
+    print(worst.to_string(index=False))
+
+def migrate_to_store():
+    '''
+    Moves the loose per-batch files in the raw data directory into the deck store.
+    '''
+    print(f'--- Migrating batch files in {RAW_DATA_DIR} into the deck store ---')
+    n = store.migrate_batch_files(RAW_DATA_DIR, remove=True)
+    print(f'--- {n} decks migrated; store holds {store.load_index(RAW_DATA_DIR)["num_decks"]} decks ---')
+
+def run_generate_process(append: bool = False):
+    '''
+    Generation stage only: fills the deck store with TOTAL_DECKS decks
+    (or appends them to it).
+    '''
+    print(f'--- Generating {TOTAL_DECKS} decks into {RAW_DATA_DIR} ---')
+    metrics = Metrics('generate')
+    generate_data(metrics, TOTAL_DECKS, append=append)
+    save_metrics(metrics)
+
+def run_score_process():
+    '''
+    Scoring stage only: scores the deck store into scoring_results.csv
+    without touching the heatmaps.
+    '''
+    print(f'--- Scoring the decks in {RAW_DATA_DIR} ---')
+    metrics = Metrics('score')
+    score_data(metrics)
+    save_metrics(metrics)
+
+def run_render_process(csv_path: str, total_decks: int | None = None, force: bool = False):
+    '''
+    Visualization stage only: creates the heatmaps of an existing scoring CSV
+    (only those whose inputs changed, unless force).
+    '''
+    print(f'--- Rendering heatmaps of {csv_path} ---')
+    metrics = Metrics('render')
+    render_results(csv_path, total_decks, metrics, force)
+    save_metrics(metrics)
+
+
+COMMANDS = ('run', 'generate', 'score', 'render', 'augment', 'exact', 'compare-exact', 'migrate-store')
+# pre-subcommand flags that are still accepted in place of the subcommand
+LEGACY_FLAGS = {'--augment': 'augment', '--exact': 'exact', '--compare-exact': 'compare-exact',
+                '--migrate-store': 'migrate-store'}
+
+def deck_range(text: str) -> tuple[int, int]:
+    '''
+    argparse type of --deck-range: 'START:STOP' -> (start, stop)
+    '''
+    try:
+        start, stop = (int(x) for x in text.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected START:STOP, got {text!r}')
+    if not 0 <= start < stop:
+        raise argparse.ArgumentTypeError(f'empty or negative deck range {text!r}')
+    return start, stop
+
+def build_parser() -> argparse.ArgumentParser:
+    '''
+    One subcommand per stage. Option groups shared by several stages are
+    parent parsers.
+    '''
+    paths = argparse.ArgumentParser(add_help=False)
+    paths.add_argument('--raw-dir', default=RAW_DATA_DIR, help='Deck store directory (default: %(default)s).')
+    paths.add_argument('--results-dir', default=RESULTS_DIR, help='Directory of the CSV, heatmaps and metrics (default: %(default)s).')
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument('--workers', type=int, metavar='W', help='Number of generation and scoring processes (default: all cores).')
+
+    seeding = argparse.ArgumentParser(add_help=False)
+    seeding.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Decks per generated batch (default: %(default)s).')
+    seeding.add_argument('--seed', type=int, default=SEED, help='Root seed of the deck generator (default: %(default)s).')
+
+    decks = argparse.ArgumentParser(add_help=False)
+    decks.add_argument('--decks', type=int, default=TOTAL_DECKS, help='Number of decks to generate (default: %(default)s).')
+
+    resume = argparse.ArgumentParser(add_help=False)
+    resume.add_argument('--resume', action='store_true', help='Continue an interrupted run from its checkpoints.')
+
+    scoring = argparse.ArgumentParser(add_help=False)
+    scoring.add_argument('--chunk-decks', type=int, metavar='D', default=CHUNK_DECKS, help='Decks per scoring task (default: %(default)s).')
+    scoring.add_argument('--no-progress', action='store_true', help='Do not print the live scoring progress line.')
+    scoring.add_argument('--prefetch', type=int, metavar='K', default=PREFETCH,
+                         help='Chunks each scoring worker loads and decompresses ahead on a background thread (0: off; default: %(default)s).')
+    scoring.add_argument('--profile', metavar='DIR', help='cProfile every scoring worker into DIR/worker_<pid>.prof.')
+    scoring.add_argument('--symmetry', choices=sc.SYMMETRY_MODES,
+                         help="Use the red/black complement symmetry: 'half' scores half the pairs, 'double' pools each pair with its mirror.")
+    scoring.add_argument('--orbit-check', action='store_true', help='Print the measured rate differences between mirrored pairs.')
+    scoring.add_argument('--rules', default=','.join(RULES), metavar='R1,R2',
+                         help=f"Scoring rules evaluated in one pass over the decks, one CSV each ({', '.join(sc.SCORING_RULES)}; default: %(default)s).")
 
-    args = parser.parse_args()
+    in_memory = argparse.ArgumentParser(add_help=False)
+    in_memory.add_argument('--stream', type=int, metavar='N', help='Generate and score N decks in memory, writing no raw deck files.')
+    in_memory.add_argument('--target-ci', type=float, metavar='W', help='Generate and score decks in memory until every 95%% CI half-width is at most W.')
+    in_memory.add_argument('--deck-range', type=deck_range, metavar='START:STOP',
+                           help='Regenerate and score decks START..STOP-1 of the counter-based deck space of --seed, with no raw files.')
+    in_memory.add_argument('--max-decks', type=int, metavar='N', help='With --target-ci: stop after N decks even if not converged.')
+    in_memory.add_argument('--seq-len', type=int, default=SEQ_LEN, help='Cards per player sequence (default: %(default)s).')
+    in_memory.add_argument('--colors', type=int, default=N_COLORS, help='Number of card colors (default: %(default)s).')
+    in_memory.add_argument('--cards-per-color', type=int, default=CARDS_PER_COLOR, help='Cards of each color per deck (default: %(default)s).')
+    in_memory.add_argument('--shoe-decks', type=int, default=SHOE_DECKS, help='Decks shuffled into one shoe (default: %(default)s).')
+
+    parser = argparse.ArgumentParser(description='Run the card game simulation pipeline. Without a subcommand, runs the full pipeline (run).')
+    sub = parser.add_subparsers(dest='command', metavar='COMMAND')
+    sub.add_parser('run', parents=[paths, workers, seeding, decks, resume, scoring, in_memory],
+                   help='Generate, score and render (the default).')
+    p = sub.add_parser('generate', parents=[paths, workers, seeding, decks, resume], help='Generate decks into the deck store.')
+    p.add_argument('--append', action='store_true', help='Add the decks to the existing store instead of starting a new one.')
+    sub.add_parser('score', parents=[paths, workers, seeding, resume, scoring, in_memory],
+                   help='Score the deck store (or decks generated in memory) into the CSV, without heatmaps.')
+    p = sub.add_parser('render', parents=[paths], help='Create the heatmaps of a scoring CSV.')
+    p.add_argument('--csv', help='Scoring CSV (default: RESULTS_DIR/scoring_results.csv).')
+    p.add_argument('--decks', type=int, help='Deck count shown in the titles (default: read from the CSV).')
+    p.add_argument('--force', action='store_true', help='Redraw the heatmaps even if their inputs did not change.')
+    p = sub.add_parser('augment', parents=[paths, workers, seeding, scoring],
+                       help='Generate N new decks and update scores and figures.')
+    p.add_argument('n', type=int, metavar='N')
+    sub.add_parser('exact', parents=[paths], help='Compute exact probabilities by dynamic programming instead of sampling.')
+    p = sub.add_parser('compare-exact', parents=[paths], help='Report how far a sampled scoring CSV is from the exact probabilities.')
+    p.add_argument('csv', nargs='?', metavar='CSV', help='Sampled CSV (default: RESULTS_DIR/scoring_results.csv).')
+    sub.add_parser('migrate-store', parents=[paths], help='Move existing per-batch .npz/.npy files into the single deck store.')
+    return parser
+
+def command_line(argv: list[str]) -> list[str]:
+    '''
+    Defaults to the run subcommand and maps the old mode flags
+    (--augment N, --exact, ...) to their subcommands.
+    '''
+    if argv and argv[0] in LEGACY_FLAGS:
+        return [LEGACY_FLAGS[argv[0]]] + argv[1:]
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ('-h', '--help')):
+        return ['run'] + argv
+    return argv
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args(command_line(sys.argv[1:]))
+    RAW_DATA_DIR, RESULTS_DIR = args.raw_dir, args.results_dir
+    WORKERS = getattr(args, 'workers', WORKERS)
+    BATCH_SIZE = getattr(args, 'batch_size', BATCH_SIZE)
+    SEED = getattr(args, 'seed', SEED)
+    RESUME = getattr(args, 'resume', RESUME)
+    if BATCH_SIZE < 1:
+        parser.error('--batch-size must be at least 1')
+    if args.command in ('run', 'generate'):
+        TOTAL_DECKS = args.decks
+    if hasattr(args, 'chunk_decks'):
+        CHUNK_DECKS = args.chunk_decks
+        if CHUNK_DECKS < 1:
+            parser.error('--chunk-decks must be at least 1')
+        PROGRESS = not args.no_progress
+        PROFILE_DIR = args.profile
+        PREFETCH = max(0, args.prefetch)
+        SYMMETRY = args.symmetry
+        ORBIT_CHECK = args.orbit_check
+        try:
+            RULES = sc.check_rules(args.rules.split(','))
+        except ValueError as e:
+            parser.error(str(e))
+        if 'pile' not in RULES:
+            parser.error('--rules must include pile, the rule of scoring_results.csv and the heatmaps')
+        if RULES != sc.DEFAULT_RULES and args.target_ci:
+            parser.error('--target-ci only scores the pile rule')
+        if SYMMETRY and args.target_ci:
+            parser.error('--target-ci scores every pair, without --symmetry')
+    in_memory = hasattr(args, 'stream') and (args.stream or args.target_ci or args.deck_range)
+    if hasattr(args, 'seq_len'):
+        SEQ_LEN, N_COLORS = args.seq_len, args.colors
+        CARDS_PER_COLOR, SHOE_DECKS = args.cards_per_color, args.shoe_decks
+        try:
+            game_config()
+        except ValueError as e:
+            parser.error(str(e))
+        if game_config() != DEFAULT_GAME and not in_memory:
+            parser.error('non-standard games (--seq-len, --colors, --cards-per-color, --shoe-decks) run with --stream, --deck-range or --target-ci')
+        if getattr(args, 'symmetry', None) and N_COLORS != 2:
+            parser.error('--symmetry swaps red and black, it needs a two-color game')
 
-    if args.augment:
-        augment_data(args.augment)
+    render = args.command == 'run'
+    if args.command == 'generate':
+        run_generate_process(args.append)
+    elif args.command == 'render':
+        run_render_process(args.csv or os.path.join(RESULTS_DIR, 'scoring_results.csv'), args.decks, args.force)
+    elif args.command == 'augment':
+        augment_data(args.n)
+    elif args.command == 'exact':
+        run_exact_process()
+    elif args.command == 'compare-exact':
+        report_exact_error(args.csv or os.path.join(RESULTS_DIR, 'scoring_results.csv'))
+    elif args.command == 'migrate-store':
+        migrate_to_store()
+    elif args.deck_range:
+        start, stop = args.deck_range
+        run_stream_process(stop - start, render=render, first_deck=start)
+    elif args.stream:
+        run_stream_process(args.stream, render=render)
+    elif args.target_ci:
+        run_converge_process(args.target_ci, args.max_decks, render=render)
+    elif args.command == 'score':
+        run_score_process()
     else:
         run_full_process()
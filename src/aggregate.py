@@ -0,0 +1,265 @@
+import numpy as np
+import os
+import csv
+import json
+
+from src.game import GameConfig, DEFAULT_GAME
+
+# per-pair counters, in column order
+COUNTERS = (
+    'decks',
+    'p1_total_cards', 'p2_total_cards', 'p1_total_tricks', 'p2_total_tricks',
+    'cards_p1_wins', 'cards_p2_wins', 'cards_ties',
+    'tricks_p1_wins', 'tricks_p2_wins', 'tricks_ties',
+)
+COUNTER_INDEX = {name: k for k, name in enumerate(COUNTERS)}
+RULES = ('cards', 'tricks')
+
+RATE_COUNTS = {
+    'cards_p1_win_rate': 'cards_p1_wins', 'cards_p2_win_rate': 'cards_p2_wins', 'cards_tie_rate': 'cards_ties',
+    'tricks_p1_win_rate': 'tricks_p1_wins', 'tricks_p2_win_rate': 'tricks_p2_wins', 'tricks_tie_rate': 'tricks_ties',
+}
+CI_Z = 1.96  # 95% intervals
+
+# scoring CSV column -> counter
+CSV_COUNTS = {
+    'p1_cards': 'p1_total_cards', 'p2_cards': 'p2_total_cards',
+    'p1_tricks': 'p1_total_tricks', 'p2_tricks': 'p2_total_tricks',
+    'cards_p1_wins': 'cards_p1_wins', 'cards_p2_wins': 'cards_p2_wins', 'cards_ties': 'cards_ties',
+    'tricks_p1_wins': 'tricks_p1_wins', 'tricks_p2_wins': 'tricks_p2_wins', 'tricks_ties': 'tricks_ties',
+}
+
+
+def margin_widths(game: GameConfig = DEFAULT_GAME) -> tuple[int, int]:
+    '''
+    Lengths of the card and trick margin histograms: every margin from
+    -max to +max, with max the cards in a deck (52) and the most tricks a
+    deck can hold (17); margin d is counted at index d + length // 2.
+    '''
+    return 2 * game.deck_size + 1, 2 * (game.deck_size // game.seq_len) + 1
+
+def wilson_halfwidth(k, n, z: float = CI_Z):
+    '''
+    Half-width of the Wilson score interval for k successes out of n
+    (works elementwise on arrays); 0.5 when n is 0.
+    '''
+    k = np.asarray(k, dtype=float)
+    n = np.asarray(n, dtype=float)
+    safe_n = np.maximum(n, 1)
+    p = k / safe_n
+    hw = z * np.sqrt(p * (1 - p) / safe_n + z**2 / (4 * safe_n**2)) / (1 + z**2 / safe_n)
+    return np.where(n > 0, hw, 0.5)
+
+def paired_counts(k, decks, samples):
+    '''
+    Successes out of decks observations that give the rate k / samples:
+    k itself when every deck is one sample, k * decks / samples when the
+    outcomes of a deck and its complement are pooled (two correlated
+    samples per deck, which count as one paired observation).
+    '''
+    k = np.asarray(k)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(samples == decks, k, k * decks / np.maximum(samples, 1))
+
+def aggregate_path(csv_path: str) -> str:
+    '''
+    Path of the aggregate saved next to a scoring CSV
+    (results/scoring_results.csv -> results/scoring_results_aggregate.npz)
+    '''
+    return os.path.splitext(csv_path)[0] + '_aggregate.npz'
+
+
+class Aggregate:
+    '''
+    Scoring results of every ordered pair of a game in one int64 array,
+    data[player1, player2, column], players indexed by their code. The
+    columns are the COUNTERS, then the card margin histogram, then the
+    trick margin histogram (margin d at d + width // 2, see margin_widths).
+    The diagonal is never scored and stays zero.
+
+    'decks' counts the decks behind a pair. The outcome counters, totals and
+    margins normally hold one sample per deck; a pooled aggregate
+    (score.apply_symmetry 'double') holds two, the deck and its complement.
+    Rates are per sample (see samples), intervals over the decks.
+
+    agg['cards_p2_wins'] is the (players, players) matrix of one counter
+    (a view), agg.margins('cards') the (players, players, width) histograms.
+    Aggregates of the same game merge by adding their arrays.
+    '''
+
+    def __init__(self, game: GameConfig = DEFAULT_GAME, data: np.ndarray | None = None):
+        self.game = game
+        cards_width, tricks_width = margin_widths(game)
+        n = len(COUNTERS)
+        self.slices = {'cards': slice(n, n + cards_width), 'tricks': slice(n + cards_width, n + cards_width + tricks_width)}
+        shape = (game.n_players, game.n_players, n + cards_width + tricks_width)
+        if data is None:
+            data = np.zeros(shape, dtype=np.int64)
+        elif data.shape != shape:
+            raise ValueError(f'aggregate data of shape {data.shape} does not fit {game} {shape}')
+        self.data = data
+
+    def __getitem__(self, counter: str) -> np.ndarray:
+        return self.data[..., COUNTER_INDEX[counter]]
+
+    def margins(self, rule: str) -> np.ndarray:
+        '''
+        (players, players, width) margin histograms of 'cards' or 'tricks'
+        '''
+        return self.data[..., self.slices[rule]]
+
+    def copy(self) -> 'Aggregate':
+        return Aggregate(self.game, self.data.copy())
+
+    def merge(self, other: 'Aggregate') -> 'Aggregate':
+        '''
+        Adds other into this aggregate (in place) and returns it.
+        '''
+        if other.game != self.game:
+            raise ValueError(f'cannot merge results of {other.game} into {self.game}')
+        self.data += other.data
+        return self
+
+    def add_pairs(self, pairs: list[tuple[int, int]], counters: dict, cards_margins: np.ndarray,
+                  tricks_margins: np.ndarray) -> None:
+        '''
+        Adds the results of the (i, j) code pairs: counters maps counter
+        names to one value per pair, the margins are (pairs, width) arrays.
+        '''
+        if not pairs:
+            return
+        block = np.zeros((len(pairs), self.data.shape[2]), dtype=np.int64)
+        for name, values in counters.items():
+            block[:, COUNTER_INDEX[name]] = values
+        block[:, self.slices['cards']] = cards_margins
+        block[:, self.slices['tricks']] = tricks_margins
+        i, j = np.array(pairs).T
+        self.data[i, j] += block
+
+    def samples(self) -> np.ndarray:
+        '''
+        (players, players) outcomes behind each pair's rates (every sample
+        has exactly one cards outcome): the decks, or twice the decks for a
+        pooled aggregate
+        '''
+        return self['cards_p1_wins'] + self['cards_p2_wins'] + self['cards_ties']
+
+    def rates(self, counter: str) -> np.ndarray:
+        '''
+        (players, players) rate of a counter per sample, NaN for pairs
+        without decks (the diagonal)
+        '''
+        samples = self.samples()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(samples > 0, self[counter] / samples, np.nan)
+
+    def ci(self, counter: str) -> np.ndarray:
+        '''
+        (players, players) Wilson half-width of a counter's rate over the
+        pair's decks, NaN for pairs without decks
+        '''
+        decks = self['decks']
+        return np.where(decks > 0, wilson_halfwidth(paired_counts(self[counter], decks, self.samples()), decks), np.nan)
+
+    def max_ci_halfwidth(self) -> np.ndarray:
+        '''
+        (players, players) widest Wilson half-width over the six win/tie
+        rates of each pair (0.5 for pairs without decks)
+        '''
+        counts = self.data[..., [COUNTER_INDEX[c] for c in RATE_COUNTS.values()]]
+        decks = self['decks'][..., None]
+        return wilson_halfwidth(paired_counts(counts, decks, self.samples()[..., None]), decks).max(axis=-1)
+
+    # serialization
+    def to_json(self) -> dict:
+        '''
+        JSON-ready form (partials, checkpoints, shard partials)
+        '''
+        return {'game': self.game.to_dict(), 'data': self.data.tolist()}
+
+    @classmethod
+    def from_json(cls, obj: dict) -> 'Aggregate':
+        return cls(GameConfig(**obj['game']), np.array(obj['data'], dtype=np.int64))
+
+    def save(self, path: str) -> None:
+        '''
+        Saves the aggregate as a compressed .npz (data, game, counter names),
+        via a temporary file and os.replace so readers never see a
+        half-written file.
+        '''
+        tmp = f'{path}.tmp{os.getpid()}'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, data=self.data, game=json.dumps(self.game.to_dict()), counters=np.array(COUNTERS))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'Aggregate':
+        with np.load(path) as f:
+            if tuple(f['counters']) != COUNTERS:
+                raise ValueError(f'{path}: aggregate with different counters {tuple(f["counters"])}')
+            return cls(GameConfig(**json.loads(str(f['game']))), f['data'])
+
+    def csv_rows(self) -> list[dict]:
+        '''
+        One scoring CSV row per pair, in game.pairs() order: totals, outcome
+        counts, per-deck rates and the half-width of each rate's 95% Wilson
+        interval ('<rate>_ci').
+        '''
+        pairs = self.game.pairs()
+        if not pairs:
+            return []
+        players = self.game.players()
+        i, j = np.array(pairs).T
+        counts = self.data[i, j, :len(COUNTERS)]
+        decks = counts[:, COUNTER_INDEX['decks']]
+        samples = self.samples()[i, j]
+        wins = counts[:, [COUNTER_INDEX[c] for c in RATE_COUNTS.values()]]
+        columns = {col: counts[:, COUNTER_INDEX[c]].tolist() for col, c in CSV_COUNTS.items()}
+        # per-sample rates and their 95% confidence intervals (half-widths) over the decks
+        rates = (wins / np.maximum(samples, 1)[:, None]).T.tolist()
+        cis = wilson_halfwidth(paired_counts(wins, decks[:, None], samples[:, None]), decks[:, None]).T.tolist()
+        columns.update(zip(RATE_COUNTS, rates))
+        columns.update((f'{rate}_ci', v) for rate, v in zip(RATE_COUNTS, cis))
+        return [dict({'player1': players[a], 'player2': players[b]}, **{col: v[k] for col, v in columns.items()})
+                for k, (a, b) in enumerate(pairs)]
+
+    def write_csv(self, path: str) -> None:
+        rows = self.csv_rows()
+        # plain csv module: keeps pandas out of scoring-only processes
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [], lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'Aggregate':
+        '''
+        Aggregate of the counters of a scoring CSV (for CSVs saved without
+        an aggregate; the margin histograms are not in the CSV and stay 0).
+        The game is read off the players: their length and color digits.
+        Every outcome is taken as one deck, so a pooled CSV read without its
+        aggregate reports twice its decks.
+        '''
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        players = {r['player1'] for r in rows} | {r['player2'] for r in rows}
+        seq_len = len(next(iter(players)))
+        n_colors = max(2, round(len(players) ** (1 / seq_len)))
+        agg = cls(GameConfig(seq_len=seq_len, n_colors=n_colors))
+        for r in rows:
+            i, j = int(r['player1'], n_colors), int(r['player2'], n_colors)
+            for col, counter in CSV_COUNTS.items():
+                agg.data[i, j, COUNTER_INDEX[counter]] = int(r[col])
+            agg.data[i, j, COUNTER_INDEX['decks']] = sum(int(r[c]) for c in ('cards_p1_wins', 'cards_p2_wins', 'cards_ties'))
+        return agg
+
+
+def load_aggregate(csv_path: str) -> Aggregate:
+    '''
+    The aggregate behind a scoring CSV: the .npz saved next to it, or the
+    counters of the CSV itself if there is none.
+    '''
+    path = aggregate_path(csv_path)
+    if os.path.exists(path):
+        return Aggregate.load(path)
+    return Aggregate.from_csv(csv_path)
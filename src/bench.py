@@ -0,0 +1,229 @@
+'''
+Benchmark suite for the generation, scoring and visualization stages.
+
+    uv run python -m src.bench                          # run, print and save JSON
+    uv run python -m src.bench --quick                  # smaller sizes
+    uv run python -m src.bench --save-baseline FILE     # record a baseline
+    uv run python -m src.bench --baseline FILE          # fail on regressions
+
+Every case runs in a fresh worker process so its peak RSS is its own.
+'''
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing as mp
+
+from src.metrics import peak_rss_mb
+
+DEFAULT_OUT = './results/bench_results.json'
+DEFAULT_TOLERANCE = 0.25  # allowed relative slowdown / growth before failing
+
+
+def _best_time(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+# benchmark cases, each returns a dict of metrics
+def bench_kernel_archive(n_decks: int, repeat: int) -> dict:
+    '''
+    Per-deck cost of archive/score_1.score_deck over all 56 pairs.
+    '''
+    import itertools
+    import src.data_gen as dg
+    from archive.score_1 import score_deck, get_players
+
+    decks = dg.generate_decks(n_decks, 0)
+    seqs = [np.array([int(c) for c in p]) for p in get_players()]
+    pairs = list(itertools.permutations(range(8), 2))
+
+    def run():
+        for deck in decks:
+            for i, j in pairs:
+                score_deck(deck, seqs[i], seqs[j])
+
+    t = _best_time(run, repeat)
+    return {'decks': n_decks, 'seconds': t, 'decks_per_s': n_decks / t}
+
+def bench_kernel_windows(n_decks: int, repeat: int) -> dict:
+    '''
+    Per-deck cost of score.score_pair_on_windows over all 56 pairs.
+    '''
+    import itertools
+    import src.data_gen as dg
+    import src.score as sc
+
+    decks = dg.generate_decks(n_decks, 0)
+    pairs = list(itertools.permutations(range(8), 2))
+
+    def run():
+        for deck in decks:
+            win = sc.deck_to_windows(deck)
+            for i, j in pairs:
+                sc.score_pair_on_windows(win, i, j)
+
+    t = _best_time(run, repeat)
+    return {'decks': n_decks, 'seconds': t, 'decks_per_s': n_decks / t}
+
+def bench_process_file(n_decks: int, repeat: int, engine: str) -> dict:
+    '''
+    One batch file through process_file_optimized ('loop') or
+    process_file_batched ('batch'), including the load.
+    '''
+    import src.data_gen as dg
+    import src.score as sc
+
+    fn = sc.process_file_optimized if engine == 'loop' else sc.process_file_batched
+    tmp = tempfile.mkdtemp(prefix='bench_')
+    try:
+        path = dg.simulate_batch(0, n_decks, tmp, seed=0)
+        t = _best_time(lambda: fn(path), repeat)
+        return {'decks': n_decks, 'seconds': t, 'decks_per_s': n_decks / t, 'file_bytes': os.path.getsize(path)}
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_simulate_batch(n_decks: int, repeat: int, packed: bool) -> dict:
+    '''
+    data_gen.simulate_batch (generate + write) for one batch size and format.
+    '''
+    import src.data_gen as dg
+
+    tmp = tempfile.mkdtemp(prefix='bench_')
+    try:
+        t = _best_time(lambda: dg.simulate_batch(0, n_decks, tmp, seed=0, packed=packed), repeat)
+        size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp))
+        return {'decks': n_decks, 'seconds': t, 'decks_per_s': n_decks / t, 'file_bytes': size}
+    finally:
+        shutil.rmtree(tmp)
+
+def bench_visualization(n_decks: int, repeat: int) -> dict:
+    '''
+    viz.run_visualization on a scoring CSV of n_decks decks (both heatmaps).
+    '''
+    import contextlib, io
+    import src.data_gen as dg
+    import src.score as sc
+    import src.viz as viz
+
+    tmp = tempfile.mkdtemp(prefix='bench_')
+    try:
+        csv_path = os.path.join(tmp, 'scoring_results.csv')
+        results = sc.score_decks_batch(dg.generate_decks(n_decks, 0))
+        sc.write_results_csv(results, csv_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = _best_time(lambda: viz.run_visualization(csv_path, tmp, n_decks, force=True), repeat)
+        size = sum(os.path.getsize(os.path.join(tmp, f)) for f in os.listdir(tmp) if f.endswith('.png'))
+        return {'seconds': t, 'file_bytes': size}
+    finally:
+        shutil.rmtree(tmp)
+
+
+def get_cases(quick: bool) -> dict:
+    '''
+    name -> (function, kwargs) for every benchmark case
+    '''
+    scale = 1 if quick else 10
+    repeat = 1 if quick else 3
+    cases = {
+        'kernel/archive_score_deck': (bench_kernel_archive, {'n_decks': 2 * scale, 'repeat': repeat}),
+        'kernel/score_pair_on_windows': (bench_kernel_windows, {'n_decks': 20 * scale, 'repeat': repeat}),
+        'process_file/loop': (bench_process_file, {'n_decks': 100 * scale, 'repeat': repeat, 'engine': 'loop'}),
+        'process_file/batch': (bench_process_file, {'n_decks': 1_000 * scale, 'repeat': repeat, 'engine': 'batch'}),
+        'visualization/run_visualization': (bench_visualization, {'n_decks': 1_000, 'repeat': 1}),
+    }
+    for n in (1_000, 10_000, 100_000):
+        for packed in (True, False):
+            fmt = 'packed' if packed else 'npz'
+            cases[f'simulate_batch/{fmt}/n={n}'] = (bench_simulate_batch, {'n_decks': n, 'repeat': repeat, 'packed': packed})
+    return cases
+
+def _run_case(item: tuple[str, bool]) -> dict:
+    name, quick = item
+    fn, kwargs = get_cases(quick)[name]
+    metrics = fn(**kwargs)
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    return metrics
+
+def run_benchmarks(quick: bool = False, only: str | None = None) -> dict:
+    '''
+    Runs every case (or those whose name contains only) in its own process.
+    '''
+    import numpy
+    names = [n for n in get_cases(quick) if not only or only in n]
+    ctx = mp.get_context('spawn')
+    results = {}
+    for name in names:
+        with ctx.Pool(processes=1, maxtasksperchild=1) as pool:
+            results[name] = pool.map(_run_case, [(name, quick)])[0]
+        m = results[name]
+        rate = f"{m['decks_per_s']:>12,.0f} decks/s" if 'decks_per_s' in m else f"{m['seconds']:>10.3f} s     "
+        print(f'[bench] {name:<40} {rate}  peak RSS {m["peak_rss_mb"]:7.1f} MB')
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': numpy.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'quick': quick,
+        },
+        'benchmarks': results,
+    }
+
+
+def compare_to_baseline(current: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list[str]:
+    '''
+    Compares two benchmark reports case by case. Returns one message per
+    regression: throughput (decks_per_s) lower, or time / peak RSS / file
+    size higher, than the baseline by more than tolerance.
+    '''
+    regressions = []
+    for name, base in baseline['benchmarks'].items():
+        cur = current['benchmarks'].get(name)
+        if cur is None:
+            continue
+        checks = [('decks_per_s', -1)] if 'decks_per_s' in base else [('seconds', 1)]
+        checks += [('peak_rss_mb', 1), ('file_bytes', 1)]
+        for key, direction in checks:
+            if key not in base or key not in cur or not base[key]:
+                continue
+            change = (cur[key] - base[key]) / base[key] * direction
+            if change > tolerance:
+                regressions.append(f'{name}: {key} {base[key]:,.3f} -> {cur[key]:,.3f} ({change:+.0%} worse)')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the generation, scoring and visualization stages.')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes and a single repeat.')
+    parser.add_argument('--only', metavar='SUBSTR', help='Only run cases whose name contains SUBSTR.')
+    parser.add_argument('--out', default=DEFAULT_OUT, help='Where to write the JSON report (default: %(default)s).')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare against a saved report and exit 1 on regressions.')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Also save this report as a baseline.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed relative regression (default: %(default)s).')
+    args = parser.parse_args()
+
+    report = run_benchmarks(quick=args.quick, only=args.only)
+    for path in filter(None, (args.out, args.save_baseline)):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f'[bench] Report saved to {args.out}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f'[bench] {len(regressions)} regression(s) against {args.baseline}:')
+            for r in regressions:
+                print(f'  {r}')
+            sys.exit(1)
+        print(f'[bench] No regressions against {args.baseline}')
@@ -1,7 +1,12 @@
 import numpy as np
 import os, time, random, json
+from multiprocessing import Pool, cpu_count
+from contextlib import nullcontext
 from typing import Tuple
 
+import src.store as store
+from src.game import GameConfig, DEFAULT_GAME
+
 
 def ensure_dir(path: str):
     '''
@@ -15,31 +20,226 @@ def batch_filename_raw(batch_idx: int, batch_size: int, out_dir: str) -> str:
     '''
     return os.path.join(out_dir, f'_rawDecks_{batch_idx}_n={batch_size}.npz')
 
-def simulate_batch(batch_idx: int, batch_size: int, out_dir: str, seed: int = 12345) -> str:
+def batch_filename_packed(batch_idx: int, batch_size: int, out_dir: str) -> str:
+    '''
+    Create filename for a bit-packed deck batch stored as .npy
+    '''
+    return os.path.join(out_dir, f'_packedDecks_{batch_idx}_n={batch_size}.npy')
+
+def is_batch_file(filename: str) -> bool:
+    '''
+    True for raw (.npz) and bit-packed (.npy) deck batch files
+    '''
+    name = os.path.basename(filename)
+    return (name.startswith('_rawDecks_') and name.endswith('.npz')) or \
+           (name.startswith('_packedDecks_') and name.endswith('.npy'))
+
+def list_batch_files(out_dir: str) -> list[str]:
+    '''
+    Paths of all deck batch files (raw or packed) in out_dir, sorted by batch index
     '''
-    Generate one batch of raw decks and save as a single npz file
-    shape: (batch_size, 52), dtype=uint8, key='decks'
+    if not os.path.isdir(out_dir):
+        return []
+    files = [f for f in os.listdir(out_dir) if is_batch_file(f)]
+    files.sort(key=batch_index_of)
+    return [os.path.join(out_dir, f) for f in files]
+
+def batch_index_of(filename: str) -> int:
+    '''
+    Parse the batch index out of a batch filename
+    '''
+    return int(os.path.basename(filename).split('_')[2])
+
+def next_batch_index(out_dir: str) -> int:
+    '''
+    First batch index not used by any batch file or deck store batch in out_dir
+    '''
+    used = [batch_index_of(f) for f in list_batch_files(out_dir)]
+    used += [b['batch_idx'] for b in store.load_index(out_dir)['batches']]
+    return max(used, default=-1) + 1
+
+def pack_decks(decks: np.ndarray) -> np.ndarray:
+    '''
+    Pack (N, 52) 0/1 decks into (N,) uint64 words, card i stored at bit 51 - i
+    (so the first card is the most significant of the 52 used bits).
+    Two-color shoes of up to 64 cards (GameConfig.packable) pack the same way.
+    '''
+    size = decks.shape[-1]
+    if size > 64:
+        raise ValueError(f'cannot pack {size}-card decks into 64-bit words')
+    weights = np.uint64(1) << np.arange(size - 1, -1, -1, dtype=np.uint64)
+    return (decks.astype(np.uint64) * weights).sum(axis=-1, dtype=np.uint64)
+
+def unpack_decks(packed: np.ndarray, deck_size: int = 52) -> np.ndarray:
+    '''
+    Inverse of pack_decks: (N,) uint64 words back to (N, 52) uint8 decks.
+    '''
+    shifts = np.arange(deck_size - 1, -1, -1, dtype=np.uint64)
+    return ((packed[..., None] >> shifts) & np.uint64(1)).astype(np.uint8)
+
+def load_decks(path: str) -> np.ndarray:
+    '''
+    Load a batch file as (N, 52) uint8 decks, whichever format it is in
+    '''
+    if path.endswith('.npy'):
+        return unpack_decks(np.load(path))
+    return np.load(path)['decks']
+
+def batch_seed(root_seed: int, batch_idx: int) -> np.random.SeedSequence:
+    '''
+    Independent random stream of one batch, derived from the root seed and
+    the batch index only (a SeedSequence spawn keyed by batch_idx), so a
+    batch's decks do not depend on which process or in which order it is made.
+    '''
+    return np.random.SeedSequence(root_seed, spawn_key=(batch_idx,))
+
+def generate_decks(batch_size: int, seed, game: GameConfig = DEFAULT_GAME) -> np.ndarray:
+    '''
+    Generate (batch_size, 52) uint8 decks of 26 zeros and 26 ones in one
+    batched operation: argsort of a (batch_size, 52) block of random keys
+    gives one uniform permutation per row, and position j holds a one when
+    the base-deck index sorted there is in the second half.
+    The result depends only on seed (an int or a SeedSequence).
+
+    For other games the shoe has game.deck_size cards, an equal number of
+    each of game.n_colors colors; the base shoe holds color c at indices
+    [c * k, (c + 1) * k) with k cards per color, so the standard game gives
+    the same decks as before.
+    '''
+    rng = np.random.default_rng(seed)
+    return decks_from_keys(rng.random((batch_size, game.deck_size)), game)
+
+def decks_from_keys(keys: np.ndarray, game: GameConfig = DEFAULT_GAME) -> np.ndarray:
+    '''
+    Decks of a (N, deck_size) block of uniform random keys: the argsort of
+    each row is a uniform permutation of the base shoe (see generate_decks).
+    '''
+    order = keys.argsort(axis=1)
+    per_color = game.cards_per_color * game.n_decks
+    if game.n_colors == 2:
+        return (order >= per_color).astype(np.uint8)
+    return (order // per_color).astype(np.uint8)
+
+# counter-based decks: deck i of a seed is a pure function of (seed, i)
+def deck_blocks(game: GameConfig = DEFAULT_GAME) -> int:
+    '''
+    Philox counter blocks (4 random 64-bit words each) reserved per deck:
+    one word per card, rounded up to whole blocks
+    '''
+    return -(-game.deck_size // 4)
+
+def generate_deck_range(start: int, stop: int, seed: int = 12345, game: GameConfig = DEFAULT_GAME) -> np.ndarray:
+    '''
+    Decks start..stop-1 of the counter-based deck space of seed, as
+    (stop - start, 52) uint8 decks. A Philox generator keyed by the seed is
+    started at counter start * deck_blocks(game), so deck i only depends on
+    (seed, i): any range is regenerated directly in O(stop - start), with
+    the same decks whatever range or process it is asked from.
+    (This is a different deck space from the batch streams of batch_seed.)
+    '''
+    if not 0 <= start <= stop:
+        raise ValueError(f'invalid deck range [{start}, {stop})')
+    blocks = deck_blocks(game)
+    rng = np.random.Generator(np.random.Philox(key=seed, counter=start * blocks))
+    keys = rng.random((stop - start, 4 * blocks))[:, :game.deck_size]
+    return decks_from_keys(keys, game)
+
+def generate_deck(deck_idx: int, seed: int = 12345, game: GameConfig = DEFAULT_GAME) -> np.ndarray:
+    '''
+    Deck deck_idx of the counter-based deck space of seed (see generate_deck_range)
+    '''
+    return generate_deck_range(deck_idx, deck_idx + 1, seed, game)[0]
+
+def simulate_batch(batch_idx: int, batch_size: int, out_dir: str, seed: int = 12345,
+                   packed: bool = True, compress: bool = True) -> str:
+    '''
+    Generate one batch of raw decks (stream batch_seed(seed, batch_idx))
+    and save it as a single file.
+    packed=True: .npy of shape (batch_size,), dtype=uint64 (see pack_decks)
+    packed=False: .npz of shape (batch_size, 52), dtype=uint8, key='decks',
+    zlib-compressed unless compress=False
     Returns the file path.
     '''
 
     ensure_dir(out_dir)
 
-    rng = np.random.default_rng(seed + batch_idx)
-    base = np.array([0]*26 + [1]*26, dtype = np.uint8)
-    decks = np.empty((batch_size, 52), dtype=np.uint8)
-
-    for i in range(batch_size):
-        decks[i] = rng.permutation(base)
+    decks = generate_decks(batch_size, batch_seed(seed, batch_idx))
 
-    path = batch_filename_raw(batch_idx, batch_size, out_dir)
-    np.savez_compressed(path, decks=decks)
+    if packed:
+        path = batch_filename_packed(batch_idx, batch_size, out_dir)
+        np.save(path, pack_decks(decks))
+    else:
+        path = batch_filename_raw(batch_idx, batch_size, out_dir)
+        save = np.savez_compressed if compress else np.savez
+        save(path, decks=decks)
     return path
 
+def _generate_into_store(task: tuple[str, int, int, int, int]) -> tuple[int, float]:
+    '''
+    Pool worker: generates one batch and writes it into its reserved slice
+    of the store. Returns (batch_idx, seconds).
+    '''
+    store_dir, batch_idx, offset, count, seed = task
+    t0 = time.perf_counter()
+    decks = generate_decks(count, batch_seed(seed, batch_idx))
+    store.write_range(store_dir, offset, pack_decks(decks))
+    return batch_idx, time.perf_counter() - t0
+
+GEN_CHECKPOINT_BATCHES = 10  # generated batches committed to the store index at a time
+
+def generate_to_store(store_dir: str, n_decks: int, batch_size: int, seed: int = 12345,
+                      first_batch_idx: int = 0, workers: int | None = None,
+                      resume: bool = False, checkpoint_every: int = GEN_CHECKPOINT_BATCHES) -> list[dict]:
+    '''
+    Generate n_decks decks in batches of batch_size across a process pool and
+    append them to the deck store. Space for all batches is reserved up
+    front and each worker writes its own slice, so the store contents are
+    identical for any number of workers.
+
+    Finished batches are committed to the store index (atomically) every
+    checkpoint_every batches, so the index always records which batches are
+    complete. With resume=True, batches of the plan that are already in the
+    store are skipped and only the missing ones are generated; an
+    interrupted run picks up where it stopped.
+
+    Returns the index entries of the new batches, each with its generation
+    time under 'gen_time_s'.
+    '''
+    sizes = [min(batch_size, n_decks - lo) for lo in range(0, n_decks, batch_size)]
+    planned = [(first_batch_idx + b, size, seed) for b, size in enumerate(sizes)]
+    if resume:
+        done = {b['batch_idx'] for b in store.load_index(store_dir)['batches']}
+        planned = [p for p in planned if p[0] not in done]
+        print(f'[generate] Resuming: {len(sizes) - len(planned)} of {len(sizes)} batches already in the store.')
+    if not planned:
+        return []
+    entries = store.reserve_batches(store_dir, planned)
+    by_idx = {e['batch_idx']: e for e in entries}
+    tasks = [(store_dir, e['batch_idx'], e['offset'], e['count'], seed) for e in entries]
+
+    timings = {}
+    finished = []
+    def checkpoint(force: bool = False):
+        if finished and (force or len(finished) >= checkpoint_every):
+            store.commit_batches(store_dir, [by_idx[b] for b in finished])
+            finished.clear()
+
+    num_processes = max(1, min(workers or cpu_count(), len(tasks)))
+    with Pool(processes=num_processes) if num_processes > 1 else nullcontext() as pool:
+        done = pool.imap_unordered(_generate_into_store, tasks) if pool else map(_generate_into_store, tasks)
+        for batch_idx, seconds in done:
+            timings[batch_idx] = seconds
+            finished.append(batch_idx)
+            checkpoint()
+    checkpoint(force=True)
+
+    return [dict(e, gen_time_s=timings[e['batch_idx']]) for e in entries]
+
 # performance
 def time_size_testing(out_dir: str, batch_size: int = 10_000, batches: int = 2, seed: int = 12345) -> dict:
     '''
     Measure generation + write time for raw deck batches.
-    Produces one .npz per batch and summarizes sizes/timings in perf_results.json
+    Produces one packed .npy per batch and summarizes sizes/timings in perf_results.json
     '''
     ensure_dir(out_dir)
     results = {'batch_idx': [], 'gen_write_time_s': [], 'file_mb': []}
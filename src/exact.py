@@ -0,0 +1,163 @@
+import numpy as np
+import os
+import math
+import itertools
+import pandas as pd
+
+from src.score import write_results_csv
+from src.aggregate import Aggregate
+from src.game import GameConfig
+
+
+def _exact_pair(s1_code: int, s2_code: int, by_cards: bool,
+                n_zero: int = 26, n_one: int = 26) -> tuple[np.ndarray, int, int]:
+    '''
+    Exact dynamic program for one pair under one rule.
+
+    Deals the deck card by card and tracks, for every color sequence dealt so
+    far, the state (ones dealt, pile size, last two cards, p1 - p2 margin).
+    Every arrangement of n_zero zeros and n_one ones is counted once, so all
+    numbers are exact integers over the C(n_zero + n_one, n_one) decks.
+
+    by_cards=True scores the pile (cards), by_cards=False scores tricks, where
+    the pile only matters up to "at least 2 cards dealt since the last trick".
+
+    Returns (margin_counts, p1_total, p2_total): margin_counts[d + offset] is
+    the number of decks that end with margin d, offset = len // 2.
+    '''
+    n_cards = n_zero + n_one
+    max_margin = n_cards if by_cards else n_cards // 3
+    n_margin = 2 * max_margin + 1
+    n_pile = n_cards + 1 if by_cards else 3
+
+    # S[ones dealt, pile, last two cards, margin + max_margin]
+    S = np.zeros((n_one + 1, n_pile, 4, n_margin), dtype=np.int64)
+    S[0, 0, 0, max_margin] = 1
+    p1_total = p2_total = 0
+
+    for k in range(n_cards):
+        N = np.zeros_like(S)
+        hi = min(k, n_pile - 1)  # piles above k are unreachable
+
+        for c in (0, 1):
+            src = slice(0, n_one + 1 - c)
+            dst = slice(c, n_one + 1)
+            # completions of the deck after this card, per destination row
+            rows = np.arange(c, n_one + 1)
+            rest = n_cards - (k + 1)
+            completions = np.array([math.comb(rest, n_one - r) if 0 <= n_one - r <= rest else 0
+                                    for r in rows], dtype=np.int64)
+
+            for b0 in range(4):
+                code = (b0 << 1) | c
+                b1 = code & 3
+
+                # fewer than 3 cards in the pile: no window yet
+                for p in range(min(2, hi + 1)):
+                    N[dst, p + 1, b1] += S[src, p, b0]
+
+                if hi < 2:
+                    continue
+
+                if code != s1_code and code != s2_code:
+                    if by_cards:
+                        N[dst, 3:hi + 2, b1] += S[src, 2:hi + 1, b0]
+                    else:
+                        N[dst, 2, b1] += S[src, 2, b0]
+                    continue
+
+                # a trick is taken: pile resets, margin moves by the pile (or by 1)
+                sign = 1 if code == s1_code else -1
+                for p in range(2, hi + 1):
+                    flow = S[src, p, b0]
+                    gain = p + 1 if by_cards else 1
+                    if sign > 0:
+                        N[dst, 0, 0, gain:] += flow[:, :n_margin - gain]
+                    else:
+                        N[dst, 0, 0, :n_margin - gain] += flow[:, gain:]
+                    total = int(flow.sum(axis=1) @ completions) * gain
+                    if sign > 0:
+                        p1_total += total
+                    else:
+                        p2_total += total
+
+        # drop rows that used more zeros than the deck has
+        N[:max(0, k + 1 - n_zero)] = 0
+        S = N
+
+    margin_counts = S[n_one].sum(axis=(0, 1))
+    return margin_counts, p1_total, p2_total
+
+
+def exact_results(n_zero: int = 26, n_one: int = 26) -> tuple[Aggregate, int]:
+    '''
+    Exact counterpart of score.run_simulation: the aggregate over every
+    distinct deck, computed with _exact_pair for all 56 pairs and both rules.
+
+    Returns (aggregate, total_decks) with total_decks = C(52, 26).
+    '''
+    if n_zero != n_one:
+        raise ValueError('the aggregate holds decks with the same number of cards of each color')
+    total_decks = math.comb(n_zero + n_one, n_one)
+    results = Aggregate(GameConfig(cards_per_color=n_zero))
+
+    for i, j in itertools.permutations(range(8), 2):
+        results['decks'][i, j] = total_decks
+        for rule in ('cards', 'tricks'):
+            margins, p1_total, p2_total = _exact_pair(i, j, rule == 'cards', n_zero, n_one)
+            mid = len(margins) // 2
+            results[f'p1_total_{rule}'][i, j] = p1_total
+            results[f'p2_total_{rule}'][i, j] = p2_total
+            results[f'{rule}_p1_wins'][i, j] = margins[mid + 1:].sum()
+            results[f'{rule}_p2_wins'][i, j] = margins[:mid].sum()
+            results[f'{rule}_ties'][i, j] = margins[mid]
+            results.margins(rule)[i, j] = margins
+
+    return results, total_decks
+
+
+def run_exact(output_csv_path: str) -> int:
+    '''
+    Computes exact win/tie probabilities and saves them with the same CSV
+    schema as score.run_simulation (counts are over all C(52, 26) decks).
+    '''
+    results, total_decks = exact_results()
+    write_results_csv(results, output_csv_path)
+    print(f'Exact results saved to {output_csv_path}\nTotal decks enumerated: {total_decks}')
+    return total_decks
+
+
+RATE_COLUMNS = [
+    'cards_p1_win_rate', 'cards_p2_win_rate', 'cards_tie_rate',
+    'tricks_p1_win_rate', 'tricks_p2_win_rate', 'tricks_tie_rate',
+]
+
+def compare_to_exact(sampled_csv: str, exact_csv: str) -> pd.DataFrame:
+    '''
+    Compares the rates of a sampled scoring CSV against the exact CSV
+    (computing it first if missing).
+
+    Returns one row per pair and rate with the absolute error and its
+    z-score (error / binomial standard error of the sampled rate).
+    '''
+    if not os.path.exists(exact_csv):
+        run_exact(exact_csv)
+
+    dtypes = {'player1': str, 'player2': str}
+    sampled = pd.read_csv(sampled_csv, dtype=dtypes)
+    exact = pd.read_csv(exact_csv, dtype=dtypes)
+    merged = sampled.merge(exact, on=['player1', 'player2'], suffixes=('_sampled', '_exact'))
+    n = sampled['cards_p1_wins'] + sampled['cards_p2_wins'] + sampled['cards_ties']
+
+    rows = []
+    for col in RATE_COLUMNS:
+        p_hat = merged[f'{col}_sampled']
+        p = merged[f'{col}_exact']
+        se = np.sqrt(p * (1 - p) / n.to_numpy())
+        err = p_hat - p
+        rows.append(pd.DataFrame({
+            'player1': merged['player1'], 'player2': merged['player2'], 'rate': col,
+            'sampled': p_hat, 'exact': p, 'abs_error': err.abs(),
+            'z': np.where(se > 0, err / np.where(se > 0, se, 1), 0.0),
+        }))
+    return pd.concat(rows, ignore_index=True)
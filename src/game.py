@@ -0,0 +1,111 @@
+from dataclasses import dataclass, asdict
+
+COLOR_LETTERS = 'BRGYKW'  # display letter of color 0, 1, 2, ...
+
+
+@dataclass(frozen=True)
+class GameConfig:
+    '''
+    Parameters of the game, shared by data_gen, score and viz.
+
+    seq_len: cards in a player's sequence (3 in the standard game)
+    n_colors: number of card colors (2: black = 0, red = 1)
+    cards_per_color: cards of each color in one deck (26)
+    n_decks: decks shuffled together into one shoe (1)
+
+    Players are all n_colors ** seq_len sequences. A sequence is coded as a
+    base-n_colors integer, first card most significant, and written as a
+    string of color digits ('010'). Windows of the dealt cards use the same
+    code, so a window matches a player when the codes are equal.
+    '''
+    seq_len: int = 3
+    n_colors: int = 2
+    cards_per_color: int = 26
+    n_decks: int = 1
+
+    def __post_init__(self):
+        if self.seq_len < 1 or self.n_colors < 2 or self.cards_per_color < 1 or self.n_decks < 1:
+            raise ValueError(f'invalid game parameters: {self}')
+        if self.n_colors > len(COLOR_LETTERS):
+            raise ValueError(f'at most {len(COLOR_LETTERS)} colors are supported')
+        if self.deck_size < self.seq_len:
+            raise ValueError(f'a deck of {self.deck_size} cards has no {self.seq_len}-card window')
+
+    @property
+    def deck_size(self) -> int:
+        '''Cards in one shoe'''
+        return self.n_colors * self.cards_per_color * self.n_decks
+
+    @property
+    def n_windows(self) -> int:
+        '''Window positions in one shoe'''
+        return self.deck_size - self.seq_len + 1
+
+    @property
+    def n_players(self) -> int:
+        '''Number of possible sequences'''
+        return self.n_colors ** self.seq_len
+
+    @property
+    def packable(self) -> bool:
+        '''True if a shoe fits one uint64 word (see data_gen.pack_decks)'''
+        return self.n_colors == 2 and self.deck_size <= 64
+
+    @property
+    def window_dtype(self):
+        '''Smallest unsigned dtype that holds every window code'''
+        import numpy as np
+        return np.uint8 if self.n_players <= 256 else np.uint16
+
+    def players(self) -> list[str]:
+        '''
+        All sequences as color-digit strings, in code order
+        ['000', '001', ..., '111'] for the standard game
+        '''
+        return [player_string(code, self) for code in range(self.n_players)]
+
+    def pairs(self) -> list[tuple[int, int]]:
+        '''
+        All ordered (player1, player2) code pairs with different players
+        '''
+        n = self.n_players
+        return [(i, j) for i in range(n) for j in range(n) if i != j]
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+DEFAULT_GAME = GameConfig()
+
+
+def player_string(code: int, game: GameConfig = DEFAULT_GAME) -> str:
+    '''
+    Color-digit string of a sequence code, e.g. 5 -> '101'
+    '''
+    digits = []
+    for _ in range(game.seq_len):
+        code, d = divmod(code, game.n_colors)
+        digits.append(str(d))
+    return ''.join(reversed(digits))
+
+def player_code(player: str, game: GameConfig = DEFAULT_GAME) -> int:
+    '''
+    Inverse of player_string
+    '''
+    return int(player, game.n_colors)
+
+def sequence_label(player: str) -> str:
+    '''
+    Display label of a color-digit string, e.g. '010' -> 'BRB'
+    '''
+    return ''.join(COLOR_LETTERS[int(d)] for d in player)
+
+def parse_player(player: str) -> str:
+    '''
+    Color-digit string of a player given as digits ('011') or letters ('BRR')
+    '''
+    if player and player[0] in COLOR_LETTERS:
+        if not all(c in COLOR_LETTERS for c in player):
+            raise ValueError(f'unknown color letter in {player!r}, expected {COLOR_LETTERS}')
+        return ''.join(str(COLOR_LETTERS.index(c)) for c in player)
+    return player
@@ -0,0 +1,72 @@
+import numpy as np
+import os
+
+from src.game import parse_player
+
+RULES = ('cards', 'tricks')
+
+
+def margins_path(csv_path: str) -> str:
+    '''
+    Path of the margin histograms saved next to a scoring CSV
+    (results/scoring_results.csv -> results/scoring_results_margins.npz)
+    '''
+    return os.path.splitext(csv_path)[0] + '_margins.npz'
+
+def save_margins(results, path: str) -> None:
+    '''
+    Saves the margin histograms of an aggregate.Aggregate as a compressed
+    .npz: player1, player2 (strings, one per pair) and cards, tricks (int64,
+    one row per pair, margin d at column d + width // 2).
+    '''
+    players = results.game.players()
+    i, j = np.array(results.game.pairs()).T
+    np.savez_compressed(
+        path,
+        player1=np.array([players[a] for a in i]),
+        player2=np.array([players[b] for b in j]),
+        cards=results.margins('cards')[i, j],
+        tricks=results.margins('tricks')[i, j],
+    )
+
+def load_margins(path: str) -> dict:
+    '''
+    Loads saved margin histograms:
+    {'pairs': {'011_vs_111': row, ...}, 'cards': (P, W) array, 'tricks': (P, W') array}
+    '''
+    with np.load(path) as f:
+        pairs = {f'{a}_vs_{b}': k for k, (a, b) in enumerate(zip(f['player1'], f['player2']))}
+        return {'pairs': pairs, 'cards': f['cards'], 'tricks': f['tricks']}
+
+def margin_counts(margins: dict, player1: str, player2: str, rule: str = 'cards') -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Distribution of the player1 - player2 margin of one pair under one rule.
+
+    Returns (margin values, number of decks with that margin).
+    '''
+    if rule not in RULES:
+        raise ValueError(f'unknown rule {rule!r}, expected one of {RULES}')
+    key = f'{parse_player(player1)}_vs_{parse_player(player2)}'
+    if key not in margins['pairs']:
+        raise KeyError(f'no histogram for {player1} vs {player2}')
+    counts = margins[rule][margins['pairs'][key]]
+    mid = len(counts) // 2
+    return np.arange(-mid, mid + 1), counts
+
+def margin_probability(margins: dict, player1: str, player2: str, rule: str = 'cards',
+                       at_least: int | None = None, at_most: int | None = None) -> float:
+    '''
+    Fraction of decks on which the player1 - player2 margin lies in
+    [at_least, at_most] (either bound optional). For example, how often
+    BRR (player1) beats RRR (player2) by 4 or more cards:
+
+        margin_probability(m, 'BRR', 'RRR', 'cards', at_least=4)
+    '''
+    values, counts = margin_counts(margins, player1, player2, rule)
+    keep = np.ones(len(values), dtype=bool)
+    if at_least is not None:
+        keep &= values >= at_least
+    if at_most is not None:
+        keep &= values <= at_most
+    total = counts.sum()
+    return float(counts[keep].sum() / total) if total else float('nan')
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    '''
+    Peak resident memory of this process (or of its finished children) in MB
+    '''
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return rss / (1024**2) if sys.platform == 'darwin' else rss / 1024
+
+
+class Metrics:
+    '''
+    Collects wall time and counters per pipeline stage. Stages are flat
+    names, sub-stages use a slash ('scoring', 'scoring/pool',
+    'visualization/render_cards').
+    '''
+
+    def __init__(self, mode: str = ''):
+        self.mode = mode
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self.t0 = time.perf_counter()
+        self.stages: dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Times the enclosed block and adds it to the stage's 'seconds'.
+        '''
+        entry = self.stages.setdefault(name, {})
+        t0 = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = entry.get('seconds', 0.0) + time.perf_counter() - t0
+
+    def add(self, name: str, **values) -> None:
+        '''
+        Sets counters of a stage; numbers are added to what is already there.
+        '''
+        entry = self.stages.setdefault(name, {})
+        for k, v in values.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool) and isinstance(entry.get(k), (int, float)):
+                entry[k] += v
+            else:
+                entry[k] = v
+
+    def report(self) -> dict:
+        '''
+        The metrics as a JSON-ready dict, with decks/s filled in for every
+        stage that has both 'decks' and 'seconds'.
+        '''
+        stages = {}
+        for name, entry in self.stages.items():
+            entry = dict(entry)
+            if entry.get('decks') and entry.get('seconds'):
+                entry['decks_per_s'] = entry['decks'] / entry['seconds']
+            stages[name] = entry
+        return {
+            'mode': self.mode,
+            'started': self.started,
+            'total_s': time.perf_counter() - self.t0,
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_child_rss_mb': peak_rss_mb(children=True),
+            'stages': stages,
+        }
+
+    def save(self, path: str) -> None:
+        '''
+        Writes the report as JSON to path.
+        '''
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f'[metrics] Saved metrics to {path}')
+
+
+@contextmanager
+def maybe_stage(metrics: 'Metrics | None', name: str):
+    '''
+    metrics.stage(name) if metrics is given, otherwise a no-op.
+    '''
+    if metrics is None:
+        yield {}
+    else:
+        with metrics.stage(name) as entry:
+            yield entry
@@ -0,0 +1,292 @@
+'''
+Matchup queries over the scoring aggregate, as a Python API or a local HTTP
+endpoint.
+
+    uv run python -m src.query matchup RBR BRR            # one pair, both rules
+    uv run python -m src.query best RBR --rule tricks     # best reply to RBR
+    uv run python -m src.query matrix --rule cards        # full win-rate matrix
+    uv run python -m src.query serve --port 8765          # HTTP on 127.0.0.1
+
+    GET /matchup?p1=RBR&p2=BRR   /best?player=RBR&rule=tricks
+    GET /matrix?rule=cards       /stats
+
+Every rate and interval matrix is computed once per load, so a query is a
+few array lookups. The service checks the aggregate file's mtime (at most
+every check_interval seconds) and reloads it when a run such as
+main.augment_data has rewritten it.
+'''
+import numpy as np
+import os
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from urllib.parse import urlsplit, parse_qsl
+
+from src.aggregate import RATE_COUNTS, RULES, aggregate_path, load_aggregate
+from src.game import parse_player, sequence_label
+
+DEFAULT_CSV = './results/scoring_results.csv'
+DEFAULT_PORT = 8765
+CHECK_INTERVAL_S = 1.0  # seconds between two mtime checks of the aggregate
+LATENCY_WINDOW = 10_000  # latencies kept per query kind
+
+
+def as_value(x) -> float | None:
+    '''
+    A rate as a JSON value: None for NaN (a pair without decks), which is
+    not valid JSON
+    '''
+    return None if np.isnan(x) else float(x)
+
+
+class QueryService:
+    '''
+    Answers matchup, best-response and matrix queries from an in-memory
+    copy of the aggregate behind csv_path (see aggregate.load_aggregate).
+    Players are accepted as letters ('RBR') or color digits ('101');
+    answers use letters. Rates are "player1 vs player2": in the heatmaps
+    player1 is the opponent (rows) and player2 is "my choice" (columns).
+    '''
+
+    def __init__(self, csv_path: str = DEFAULT_CSV, check_interval: float = CHECK_INTERVAL_S):
+        self.csv_path = csv_path
+        self.check_interval = check_interval
+        self.latencies: dict[str, deque] = {}
+        self.counts: dict[str, int] = {}
+        self.reloads = 0
+        self._version = None
+        self._checked = 0.0
+        self._load()
+
+    def _source(self) -> str:
+        path = aggregate_path(self.csv_path)
+        return path if os.path.exists(path) else self.csv_path
+
+    def _file_version(self) -> tuple | None:
+        try:
+            st = os.stat(self._source())
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self) -> None:
+        version = self._file_version()
+        if version is None:
+            raise FileNotFoundError(f'no scoring results at {self.csv_path}')
+        agg = load_aggregate(self.csv_path)
+        self.agg = agg
+        self.players = agg.game.players()
+        self.labels = [sequence_label(p) for p in self.players]
+        self.rates = {rate: agg.rates(count) for rate, count in RATE_COUNTS.items()}
+        self.cis = {rate: agg.ci(count) for rate, count in RATE_COUNTS.items()}
+        self.decks = agg['decks']
+        self._version = version
+        self.loaded_at = time.time()
+
+    def refresh(self, force: bool = False) -> bool:
+        '''
+        Reloads the aggregate if its file changed since the last load (checked
+        at most every check_interval seconds unless force). Returns True if
+        it reloaded.
+        '''
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+        version = self._file_version()
+        if version is None or version == self._version:
+            return False
+        self._load()
+        self.reloads += 1
+        return True
+
+    def _code(self, player: str) -> int:
+        digits = parse_player(player)
+        if digits not in self.players:
+            raise ValueError(f'unknown player {player!r} for {self.agg.game}')
+        return self.players.index(digits)
+
+    def _timed(self, kind: str, fn, *args):
+        t0 = time.perf_counter()
+        self.refresh()
+        result = fn(*args)
+        self.latencies.setdefault(kind, deque(maxlen=LATENCY_WINDOW)).append(time.perf_counter() - t0)
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        return result
+
+    def _pair(self, i: int, j: int) -> dict:
+        out = {'player1': self.labels[i], 'player2': self.labels[j], 'decks': int(self.decks[i, j])}
+        for rate in RATE_COUNTS:
+            out[rate] = as_value(self.rates[rate][i, j])
+            out[f'{rate}_ci'] = as_value(self.cis[rate][i, j])
+        return out
+
+    # queries
+    def matchup(self, player1: str, player2: str) -> dict:
+        '''
+        Win/tie rates and their 95% half-widths of player1 vs player2 under
+        both rules
+        '''
+        def pair():
+            i, j = self._code(player1), self._code(player2)
+            if i == j:
+                raise ValueError(f'{self.labels[i]} does not play against itself')
+            return self._pair(i, j)
+        return self._timed('matchup', pair)
+
+    def best_response(self, player: str, rule: str = 'cards') -> dict:
+        '''
+        The reply (player2) with the highest win rate against player
+        (player1) under rule, with its interval, plus every reply ranked.
+        '''
+        def best():
+            if rule not in RULES:
+                raise ValueError(f'unknown rule {rule!r}, expected one of {RULES}')
+            i = self._code(player)
+            wins = self.rates[f'{rule}_p2_win_rate'][i]
+            ranked = [int(j) for j in np.argsort(-np.nan_to_num(wins, nan=-1.0)) if j != i]
+            j = ranked[0]
+            return {'player': self.labels[i], 'rule': rule, 'reply': self.labels[j],
+                    'win_rate': as_value(wins[j]), 'win_rate_ci': as_value(self.cis[f'{rule}_p2_win_rate'][i, j]),
+                    'tie_rate': as_value(self.rates[f'{rule}_tie_rate'][i, j]), 'decks': int(self.decks[i, j]),
+                    'ranking': [{'reply': self.labels[k], 'win_rate': as_value(wins[k])} for k in ranked]}
+        return self._timed('best', best)
+
+    def matrix(self, rule: str = 'cards', rate: str = 'p2_win_rate') -> dict:
+        '''
+        Full players x players matrix of one rate (player1 as rows), with its
+        half-widths; None on the diagonal.
+        '''
+        def full():
+            name = f'{rule}_{rate}'
+            if name not in RATE_COUNTS:
+                raise ValueError(f'unknown rate {name!r}, expected one of {list(RATE_COUNTS)}')
+            values, cis = self.rates[name], self.cis[name]
+            as_list = lambda m: np.where(np.isnan(m), None, m).tolist()
+            return {'players': self.labels, 'rate': name, 'values': as_list(values), 'ci': as_list(cis)}
+        return self._timed('matrix', full)
+
+    def stats(self) -> dict:
+        '''
+        Query latency per kind (count, mean, p50, p95, p99, max in
+        microseconds, over the last LATENCY_WINDOW queries) and reload info
+        '''
+        self.refresh()
+        kinds = {}
+        for kind, lat in self.latencies.items():
+            us = np.array(lat) * 1e6
+            kinds[kind] = {'count': self.counts[kind], 'mean_us': float(us.mean()),
+                           'p50_us': float(np.percentile(us, 50)), 'p95_us': float(np.percentile(us, 95)),
+                           'p99_us': float(np.percentile(us, 99)), 'max_us': float(us.max())}
+        return {'source': self._source(), 'decks': int(self.decks.max()), 'reloads': self.reloads,
+                'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.loaded_at)), 'queries': kinds}
+
+    def handle(self, path: str) -> tuple[int, dict]:
+        '''
+        Answers one HTTP GET target ('/best?player=RBR&rule=tricks').
+        Returns (status, JSON body).
+        '''
+        url = urlsplit(path)
+        q = dict(parse_qsl(url.query))
+        try:
+            if url.path == '/matchup':
+                return 200, self.matchup(q['p1'], q['p2'])
+            if url.path == '/best':
+                return 200, self.best_response(q['player'], q.get('rule', 'cards'))
+            if url.path == '/matrix':
+                return 200, self.matrix(q.get('rule', 'cards'), q.get('rate', 'p2_win_rate'))
+            if url.path == '/stats':
+                return 200, self.stats()
+        except KeyError as e:
+            return 400, {'error': f'missing parameter {e.args[0]!r}'}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        return 404, {'error': f'unknown path {url.path!r}, expected /matchup, /best, /matrix or /stats'}
+
+
+# HTTP
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+async def _serve_connection(service: QueryService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    '''
+    Minimal HTTP/1.1 over one connection: GET requests with keep-alive,
+    JSON responses.
+    '''
+    try:
+        while True:
+            request = await reader.readline()
+            if not request:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                status, body = 405, {'error': 'only GET is supported'}
+            else:
+                status, body = service.handle(parts[1])
+            payload = json.dumps(body).encode()
+            close = headers.get('connection', '').lower() == 'close' or parts[-1:] == ['HTTP/1.0']
+            writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(payload)}\r\nConnection: {"close" if close else "keep-alive"}\r\n\r\n'
+                         .encode() + payload)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(service: QueryService, host: str = '127.0.0.1', port: int = DEFAULT_PORT) -> None:
+    '''
+    Serves the query endpoints until cancelled.
+    '''
+    server = await asyncio.start_server(lambda r, w: _serve_connection(service, r, w), host, port)
+    print(f'[query] Serving {service.csv_path} on http://{host}:{port} (/matchup, /best, /matrix, /stats)')
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query matchups of a scoring run.')
+    parser.add_argument('--csv', default=DEFAULT_CSV, help='Scoring CSV whose aggregate is queried (default: %(default)s).')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('matchup', help='Rates of one pair under both rules.')
+    p.add_argument('player1')
+    p.add_argument('player2')
+
+    p = sub.add_parser('best', help='Best reply to a player.')
+    p.add_argument('player')
+    p.add_argument('--rule', choices=RULES, default='cards')
+
+    p = sub.add_parser('matrix', help='Full matrix of one rate.')
+    p.add_argument('--rule', choices=RULES, default='cards')
+    p.add_argument('--rate', default='p2_win_rate', choices=['p1_win_rate', 'p2_win_rate', 'tie_rate'])
+
+    p = sub.add_parser('serve', help='Serve the queries over HTTP on localhost.')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=DEFAULT_PORT)
+    p.add_argument('--check-interval', type=float, default=CHECK_INTERVAL_S,
+                   help='Seconds between checks for an updated aggregate (default: %(default)s).')
+
+    args = parser.parse_args()
+    service = QueryService(args.csv, getattr(args, 'check_interval', CHECK_INTERVAL_S))
+    if args.command == 'matchup':
+        print(json.dumps(service.matchup(args.player1, args.player2), indent=2))
+    elif args.command == 'best':
+        print(json.dumps(service.best_response(args.player, args.rule), indent=2))
+    elif args.command == 'matrix':
+        print(json.dumps(service.matrix(args.rule, args.rate), indent=2))
+    elif args.command == 'serve':
+        try:
+            asyncio.run(serve(service, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
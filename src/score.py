@@ -1,194 +1,1306 @@
 import numpy as np
 import os
-import itertools
-import pandas as pd
+import math
+import json
+import time
+import queue
+import hashlib
+import threading
+import traceback
+import multiprocessing
 from multiprocessing import Pool, cpu_count
+from contextlib import nullcontext
 
+import src.data_gen as dg
+import src.store as store
+from src.metrics import peak_rss_mb, maybe_stage
+from src.game import GameConfig, DEFAULT_GAME
+from src.margins import margins_path, save_margins
+from src.aggregate import Aggregate, RATE_COUNTS, aggregate_path, margin_widths
 
-def get_players():
+
+def get_players(game: GameConfig = DEFAULT_GAME):
     '''
     Returns the len 8 sequences of players possible ['000', ... , '111']
+    (all game.n_players sequences for other games)
     '''
-    return [f'{i:03b}' for i in range(8)]
+    return game.players()
 
 
-def deck_to_windows(deck_bits: np.ndarray) -> np.ndarray:
+def deck_to_windows(deck_bits: np.ndarray, game: GameConfig = DEFAULT_GAME) -> np.ndarray:
     '''
     Convert a (52,) uint8 0/1 deck into (50,) uint8 window codes 0..7
     where each code is the 3-bit integer at positions [i, i+1, i+2].
+    Also accepts a (N, 52) batch of decks and returns (N, 50) codes.
+    Other games: game.seq_len-card windows as base-game.n_colors codes.
     '''
     a = deck_bits
-    # (a[i] << 2) | (a[i+1] << 1) | a[i+2]
-    return (a[:-2] << 2) | (a[1:-1] << 1) | a[2:]
+    if game.seq_len == 3 and game.n_colors == 2:
+        # (a[i] << 2) | (a[i+1] << 1) | a[i+2]
+        return (a[..., :-2] << 2) | (a[..., 1:-1] << 1) | a[..., 2:]
+    n_win = a.shape[-1] - game.seq_len + 1
+    codes = np.zeros(a.shape[:-1] + (n_win,), dtype=game.window_dtype)
+    for k in range(game.seq_len):
+        codes = codes * game.n_colors + a[..., k:k + n_win]
+    return codes
+
+def packed_to_windows(packed: np.ndarray, game: GameConfig = DEFAULT_GAME) -> np.ndarray:
+    '''
+    Bitwise equivalent of deck_to_windows for bit-packed decks (see
+    data_gen.pack_decks): (N,) uint64 words into (N, 50) uint8 window codes,
+    window i being bits [51 - i, 49 - i] pulled out with a shift and a mask.
+    '''
+    shifts = np.arange(game.deck_size - game.seq_len, -1, -1, dtype=np.uint64)
+    mask = np.uint64((1 << game.seq_len) - 1)
+    return ((packed[..., None] >> shifts) & mask).astype(game.window_dtype)
+
+def load_windows(filepath: str) -> np.ndarray:
+    '''
+    Load a batch file (packed .npy or raw .npz) straight into (N, 50) window codes.
+    '''
+    if filepath.endswith('.npy'):
+        return packed_to_windows(np.load(filepath))
+    return deck_to_windows(np.load(filepath)['decks'])
+
+# scoring rules
+# Every rule plays the same deal (a match wins a trick, restarts the pile and
+# skips seq_len windows); a rule only decides how many cards a trick is worth,
+# given the pile at the match (an int16 array in the batch engine, an int in
+# the loop kernel). Tricks are the same under every rule.
+def pile_cards(pile, seq_len: int):
+    '''The current rule: the trick takes the whole pile'''
+    return pile
 
-def score_pair_on_windows(win: np.ndarray, s1_code: int, s2_code: int) -> tuple[int, int, int, int]:
+def legacy_cards(pile, seq_len: int):
+    '''archive/score_1.score_deck: the trick takes only the seq_len matched cards'''
+    return np.int16(seq_len)
+
+SCORING_RULES = {'pile': pile_cards, 'legacy': legacy_cards}  # name -> cards won by a trick
+DEFAULT_RULES = ('pile',)
+
+def check_rules(rules) -> tuple[str, ...]:
+    '''
+    The rule names as a tuple (without repeats), after checking they are
+    registered
+    '''
+    rules = tuple(dict.fromkeys(rules))
+    unknown = [r for r in rules if r not in SCORING_RULES]
+    if not rules or unknown:
+        raise ValueError(f'unknown scoring rules {unknown}, expected some of {list(SCORING_RULES)}')
+    return rules
+
+def score_pair_on_windows(win: np.ndarray, s1_code: int, s2_code: int,
+                          seq_len: int = 3) -> tuple[int, int, int, int]:
     '''
     Head to head, greedy scoring for one combination of scores (player1 vs player) 
     which is performed on a single deck:
 
     Returns: (p1_cards, p2_cards, p1_tricks, p2_tricks)
     '''
-    pile = 2 # starts at index 2 (3)
+    (p1c,), (p2c,), p1t, p2t = score_pair_rules(win, s1_code, s2_code, seq_len, DEFAULT_RULES)
+    return p1c, p2c, p1t, p2t
+
+def score_pair_rules(win: np.ndarray, s1_code: int, s2_code: int, seq_len: int = 3,
+                     rules=DEFAULT_RULES) -> tuple[list[int], list[int], int, int]:
+    '''
+    score_pair_on_windows under several scoring rules in one pass.
+
+    Returns (p1_cards per rule, p2_cards per rule, p1_tricks, p2_tricks)
+    '''
+    gains = [SCORING_RULES[r] for r in rules]
+    pile = seq_len - 1 # starts at index 2 (3)
     i = 0
     n = len(win)  # 50
-    p1c = p2c = p1t = p2t = 0
+    p1c = [0] * len(gains)
+    p2c = [0] * len(gains)
+    p1t = p2t = 0
 
     while i < n:
         pile += 1
         w = win[i]
         if w == s1_code:
-            p1c += pile
+            for r, gain in enumerate(gains):
+                p1c[r] += int(gain(pile, seq_len))
             p1t += 1
-            pile = 2
-            i += 3
+            pile = seq_len - 1
+            i += seq_len
         elif w == s2_code:
-            p2c += pile
+            for r, gain in enumerate(gains):
+                p2c[r] += int(gain(pile, seq_len))
             p2t += 1
-            pile = 2
-            i += 3
+            pile = seq_len - 1
+            i += seq_len
         else:
             i += 1
 
     return p1c, p2c, p1t, p2t
 
+def score_pair_jump(nxt, s1_code: int, s2_code: int, seq_len: int = 3,
+                    rules=DEFAULT_RULES) -> tuple[list[int], list[int], int, int]:
+    '''
+    score_pair_rules on a deck's next-occurrence table (one deck of
+    next_occurrence, as an array or nested lists): instead of visiting every
+    window it jumps from match to match. The pile at a match follows from
+    the gap, since it grows by one per window looked at since the last
+    trick, so a pair costs O(tricks) instead of O(50).
+    '''
+    gains = [SCORING_RULES[r] for r in rules]
+    n = len(nxt) - 1  # 50
+    p1c = [0] * len(gains)
+    p2c = [0] * len(gains)
+    p1t = p2t = 0
+    i = 0
+    while i < n:
+        a, b = nxt[i][s1_code], nxt[i][s2_code]
+        t = min(a, b)
+        if t == n:
+            break
+        pile = seq_len - 1 + t - i + 1
+        if a < b:
+            for r, gain in enumerate(gains):
+                p1c[r] += int(gain(pile, seq_len))
+            p1t += 1
+        else:
+            for r, gain in enumerate(gains):
+                p2c[r] += int(gain(pile, seq_len))
+            p2t += 1
+        i = t + seq_len
+
+    return p1c, p2c, p1t, p2t
+
+def next_occurrence(windows: np.ndarray, n_codes: int) -> np.ndarray:
+    '''
+    Next-occurrence table of (N, 50) window codes: table[d, t, c] is the
+    first window position >= t of deck d holding code c, or 50 if there is
+    none; shape (N, 51, n_codes), the last row all 50 so a jump past the end
+    lands on "no match". Built once per deck in one backward pass over the
+    windows and shared by all pairs.
+    '''
+    n, n_win = windows.shape
+    table = np.empty((n, n_win + 1, n_codes), dtype=np.uint8 if n_win < 256 else np.uint16)
+    table[:, n_win] = n_win
+    rows = np.arange(n)
+    for t in range(n_win - 1, -1, -1):
+        table[:, t] = table[:, t + 1]
+        table[rows, t, windows[:, t]] = t
+    return table
+
+def score_windows_batch(windows: np.ndarray, s1_codes, s2_codes, seq_len: int = 3) -> tuple[np.ndarray, ...]:
+    '''
+    Batch version of score_pair_on_windows for every deck (rows of the
+    (N, 50) windows array) and every pair (s1_codes[k] vs s2_codes[k]) at
+    once, see score_windows_rules.
+
+    Returns (p1_cards, p2_cards, p1_tricks, p2_tricks), each of shape (N, P).
+    '''
+    cards, p1t, p2t = score_windows_rules(windows, s1_codes, s2_codes, seq_len, DEFAULT_RULES)
+    return cards['pile'][0], cards['pile'][1], p1t, p2t
+
+TABLE_MAX_BYTES = 64 * 2**20  # next-occurrence tables are built for at most this many bytes of decks at a time
+
+def score_windows_rules(windows: np.ndarray, s1_codes, s2_codes, seq_len: int = 3,
+                        rules=DEFAULT_RULES) -> tuple[dict, np.ndarray, np.ndarray]:
+    '''
+    score_windows_batch under several scoring rules in the same pass: the
+    deal is run once and each rule only adds its cards on every match.
+    Builds the next-occurrence tables of the decks (in slices of at most
+    TABLE_MAX_BYTES) and scores them with score_table_rules.
+
+    Returns ({rule: (p1_cards, p2_cards)}, p1_tricks, p2_tricks), arrays of shape (N, P).
+    '''
+    n, n_win = windows.shape
+    n_codes = int(max(windows.max(initial=0), max(s1_codes, default=0), max(s2_codes, default=0))) + 1
+    step = max(1, TABLE_MAX_BYTES // ((n_win + 1) * n_codes * 2))
+    if n <= step:
+        return score_table_rules(next_occurrence(windows, n_codes), s1_codes, s2_codes, seq_len, rules)
+    parts = [score_table_rules(next_occurrence(windows[lo:lo + step], n_codes), s1_codes, s2_codes, seq_len, rules)
+             for lo in range(0, n, step)]
+    cards = {rule: tuple(np.concatenate([p[0][rule][k] for p in parts]) for k in (0, 1)) for rule in rules}
+    return cards, np.concatenate([p[1] for p in parts]), np.concatenate([p[2] for p in parts])
+
+def score_table_rules(table: np.ndarray, s1_codes, s2_codes, seq_len: int = 3,
+                      rules=DEFAULT_RULES) -> tuple[dict, np.ndarray, np.ndarray]:
+    '''
+    score_pair_jump for every deck of a next_occurrence table and every pair
+    at once: each step looks up the next window of both players' codes for
+    all (deck, pair) entries and jumps every entry to its next trick, so the
+    number of steps is the most tricks of any entry (about 15) instead of
+    one step per window position (50). Entries past their
+    last trick look up the all-"no match" last row and stay there.
+
+    Returns ({rule: (p1_cards, p2_cards)}, p1_tricks, p2_tricks), arrays of shape (N, P).
+    '''
+    n, n_rows, n_codes = table.shape
+    n_win = n_rows - 1
+    flat = table.reshape(-1)
+    base = (np.arange(n, dtype=np.int32) * (n_rows * n_codes))[:, None]
+    pos1 = base + np.asarray(s1_codes, dtype=np.int32)[None, :]
+    pos2 = base + np.asarray(s2_codes, dtype=np.int32)[None, :]
+    shape = pos1.shape
+    gains = [SCORING_RULES[r] for r in rules]
+
+    start = np.zeros(shape, dtype=np.int16)  # first window of the current pile
+    offset = np.zeros(shape, dtype=np.int32)  # start * n_codes
+    p1c = np.zeros((len(rules),) + shape, dtype=np.int16)
+    p2c = np.zeros((len(rules),) + shape, dtype=np.int16)
+    p1t = np.zeros(shape, dtype=np.int16)
+    p2t = np.zeros(shape, dtype=np.int16)
+
+    for _ in range(-(-n_win // seq_len)):
+        a = np.take(flat, pos1 + offset)
+        b = np.take(flat, pos2 + offset)
+        t = np.minimum(a, b)
+        hit = t < n_win
+        m1 = (a < b) & hit
+        m2 = hit ^ m1
+        # the pile restarted at seq_len - 1 and grew by one per window start..t
+        pile = t.astype(np.int16)
+        pile += np.int16(seq_len) - start
+        for r, gain in enumerate(gains):
+            cards = gain(pile, seq_len)
+            p1c[r] += cards * m1
+            p2c[r] += cards * m2
+        p1t += m1
+        p2t += m2
+        if not hit.any():
+            break
+        start = np.minimum(t + np.int16(seq_len), np.int16(n_win), dtype=np.int16)
+        np.multiply(start, n_codes, out=offset)
+
+    return {rule: (p1c[r], p2c[r]) for r, rule in enumerate(rules)}, p1t, p2t
+
 # processing files
-def process_file_optimized(filepath: str) -> tuple[dict, int]:
+def process_file_optimized(filepath: str) -> tuple[Aggregate, int]:
     '''
-    Processes a single .npz 'decks' file with true head-to-head scoring utilizing
+    Processes a single batch file (packed .npy or .npz 'decks') with true head-to-head scoring utilizing
     functions above.
     
     Aggregates totals and outcome counts (wins/ties by cards and by tricks)
     for all ordered pairs (with the exception of any diagonal pairs of comb;
     i.e. 000 vs 000). 
     
-    Returns (results_dict, num_decks_in_file).
+    Returns (aggregate, num_decks_in_file).
     '''
-    players = get_players()
-    seq_codes = [int(p, 2) for p in players]  # 0..7
-
-    data = np.load(filepath)
-    decks = data['decks']  # shape (N, 52), uint8
+    decks = dg.load_decks(filepath)  # shape (N, 52), uint8
     num_decks_in_file = len(decks)
 
     if num_decks_in_file == 0:
-        return {}, 0
-
-    # Initialize aggregation container per pair
-    results = {
-        f'{players[i]}_vs_{players[j]}': {
-            'p1_total_cards': 0, 'p2_total_cards': 0,
-            'p1_total_tricks': 0, 'p2_total_tricks': 0,
-            'cards_p1_wins': 0, 'cards_p2_wins': 0, 'cards_ties': 0,
-            'tricks_p1_wins': 0, 'tricks_p2_wins': 0, 'tricks_ties': 0,
-        }
-        for i, j in itertools.permutations(range(8), 2)
+        return Aggregate(), 0
+
+    return score_decks_loop(decks), num_decks_in_file
+
+def get_pairs(game: GameConfig = DEFAULT_GAME) -> list[tuple[int, int]]:
+    '''
+    The 56 ordered (player1, player2) code pairs, in CSV row order
+    '''
+    return game.pairs()
+
+def pair_key(i: int, j: int, game: GameConfig = DEFAULT_GAME) -> str:
+    '''
+    Display key of a code pair, e.g. '000_vs_001'
+    '''
+    players = get_players(game)
+    return f'{players[i]}_vs_{players[j]}'
+
+def score_decks_loop(decks: np.ndarray, pairs: list[tuple[int, int]] | None = None,
+                     game: GameConfig = DEFAULT_GAME) -> Aggregate:
+    '''
+    Reference per-deck, per-pair loop behind process_file_optimized:
+    scores a (N, 52) array of decks and returns their aggregate
+    (for all pairs, or only the given (i, j) code pairs).
+    '''
+    return score_decks_rules(decks, pairs, game)['pile']
+
+def score_decks_rules(decks: np.ndarray, pairs: list[tuple[int, int]] | None = None,
+                      game: GameConfig = DEFAULT_GAME, rules=DEFAULT_RULES) -> dict[str, Aggregate]:
+    '''
+    score_decks_loop under several scoring rules: {rule: aggregate}
+    '''
+    pairs = get_pairs(game) if pairs is None else pairs
+    p1c = np.zeros((len(rules), len(decks), len(pairs)), dtype=np.int32)
+    p2c = np.zeros_like(p1c)
+    tricks = np.zeros((2, len(decks), len(pairs)), dtype=np.int32)
+
+    # one next-occurrence table per deck, shared by all pairs
+    tables = next_occurrence(deck_to_windows(decks, game), game.n_players)
+    for d in range(len(decks)):
+        nxt = tables[d].tolist()
+        for k, (i, j) in enumerate(pairs):
+            p1c[:, d, k], p2c[:, d, k], *tricks[:, d, k] = score_pair_jump(nxt, i, j, game.seq_len, rules)
+
+    cards = {rule: (p1c[r], p2c[r]) for r, rule in enumerate(rules)}
+    return aggregate_rules(cards, *tricks, pairs, game)
+
+
+def score_decks_batch(decks: np.ndarray, game: GameConfig = DEFAULT_GAME) -> Aggregate:
+    '''
+    Scores a (N, 52) array of decks for all 56 ordered pairs with the batch
+    engine (pile rule) and returns their Aggregate, like the one
+    process_file_optimized returns for a batch file.
+    '''
+    return score_windows_all_pairs(deck_to_windows(decks, game), game=game)
+
+def score_windows_all_pairs(windows: np.ndarray, pairs: list[tuple[int, int]] | None = None,
+                            game: GameConfig = DEFAULT_GAME) -> Aggregate:
+    '''
+    score_decks_batch for decks already decoded into (N, 50) window codes.
+    pairs: only score these (i, j) code pairs (default: all 56).
+    '''
+    return score_windows_all_rules(windows, pairs, game)['pile']
+
+def score_windows_all_rules(windows: np.ndarray, pairs: list[tuple[int, int]] | None = None,
+                            game: GameConfig = DEFAULT_GAME, rules=DEFAULT_RULES) -> dict[str, Aggregate]:
+    '''
+    score_windows_all_pairs under several scoring rules, in one pass over
+    the windows: {rule: aggregate}
+    '''
+    pairs = get_pairs(game) if pairs is None else pairs
+    s1_codes = [i for i, _ in pairs]
+    s2_codes = [j for _, j in pairs]
+
+    cards, p1t, p2t = score_windows_rules(windows, s1_codes, s2_codes, game.seq_len, rules)
+    return aggregate_rules(cards, p1t, p2t, pairs, game)
+
+def aggregate_rules(cards: dict, p1t: np.ndarray, p2t: np.ndarray,
+                    pairs: list[tuple[int, int]], game: GameConfig = DEFAULT_GAME) -> dict[str, Aggregate]:
+    '''
+    Aggregates of per-deck scores, one per rule: cards maps each rule to the
+    (N, P) cards of both players, p1t and p2t are the (N, P) tricks (the
+    same under every rule); column k belongs to pairs[k].
+    '''
+    # per-pair margin histograms, all pairs at once; the win/tie counts follow from them
+    cards_width, tricks_width = margin_widths(game)
+    tricks_margins = margin_histograms(p1t, p2t, tricks_width)
+    cm, tm = cards_width // 2, tricks_width // 2
+    tricks_counters = {
+        'decks': len(p1t),
+        'p1_total_tricks': p1t.sum(axis=0, dtype=np.int64), 'p2_total_tricks': p2t.sum(axis=0, dtype=np.int64),
+        'tricks_p1_wins': tricks_margins[:, tm + 1:].sum(axis=1),
+        'tricks_p2_wins': tricks_margins[:, :tm].sum(axis=1),
+        'tricks_ties': tricks_margins[:, tm],
     }
+    results = {}
+    for rule, (p1c, p2c) in cards.items():
+        cards_margins = margin_histograms(p1c, p2c, cards_width)
+        counters = dict(tricks_counters, **{
+            'p1_total_cards': p1c.sum(axis=0, dtype=np.int64), 'p2_total_cards': p2c.sum(axis=0, dtype=np.int64),
+            'cards_p1_wins': cards_margins[:, cm + 1:].sum(axis=1),
+            'cards_p2_wins': cards_margins[:, :cm].sum(axis=1),
+            'cards_ties': cards_margins[:, cm],
+        })
+        results[rule] = Aggregate(game)
+        results[rule].add_pairs(pairs, counters, cards_margins, tricks_margins)
+    return results
+
+def margin_histograms(a: np.ndarray, b: np.ndarray, width: int) -> np.ndarray:
+    '''
+    Per-pair histograms of the margin a - b of (N, P) score arrays, as one
+    bincount over all pairs: (P, width) int64, margin d at d + width // 2.
+    '''
+    n_pairs = a.shape[1]
+    idx = (a - b).astype(np.int32) + (width // 2 + np.arange(n_pairs, dtype=np.int32) * width)
+    return np.bincount(idx.ravel(), minlength=n_pairs * width).reshape(n_pairs, width)
+
+def process_file_batched(filepath: str) -> tuple[Aggregate, int]:
+    '''
+    Same contract as process_file_optimized, but scores every deck of the file
+    at once with score_windows_batch instead of looping deck by deck.
+
+    Returns (aggregate, num_decks_in_file).
+    '''
+    windows = load_windows(filepath)  # shape (N, 50), uint8
+    num_decks_in_file = len(windows)
+
+    if num_decks_in_file == 0:
+        return Aggregate(), 0
+
+    return score_windows_all_pairs(windows), num_decks_in_file
+
+
+# work units: loose batch files and batches of the deck store
+CHUNK_DECKS = 10_000  # default deck range handed to one worker task
+
+def list_units(raw_data_dir: str) -> list[dict]:
+    '''
+    All scoring work units of a raw data directory:
+    {'kind': 'file', 'path'} for every loose batch file (plus 'start', 'stop'
+    for packed .npy files, which can be memory-mapped) and
+    {'kind': 'store', 'dir', 'store_id', 'batch_idx', 'start', 'stop'}
+    for every batch in the deck store.
+    '''
+    units = []
+    for path in dg.list_batch_files(raw_data_dir):
+        unit = {'kind': 'file', 'path': path}
+        if path.endswith('.npy'):
+            unit['start'], unit['stop'] = 0, len(np.load(path, mmap_mode='r'))
+        units.append(unit)
+    index = store.load_index(raw_data_dir)
+    for b in index['batches']:
+        units.append({'kind': 'store', 'dir': raw_data_dir, 'store_id': index['store_id'],
+                      'batch_idx': b['batch_idx'], 'start': b['offset'], 'stop': b['offset'] + b['count']})
+    return units
 
-    # processes each deck once; reuses its window for all pairs
-    for d in range(num_decks_in_file):
-        win = deck_to_windows(decks[d])
+def merge_store_units(units: list[dict]) -> list[dict]:
+    '''
+    Replace the per-batch store units by one unit per contiguous run of
+    batches (normally one for the whole store), so chunks are cut across
+    batch boundaries and all have the same size.
+    '''
+    store_units = sorted((u for u in units if u['kind'] == 'store'), key=lambda u: u['start'])
+    if len(store_units) < 2:
+        return units
+    merged = []
+    for u in store_units:
+        if merged and merged[-1]['stop'] == u['start']:
+            merged[-1]['stop'] = u['stop']
+        else:
+            merged.append(dict(u, batch_idx=None))
+    return [u for u in units if u['kind'] != 'store'] + merged
 
-        for i, j in itertools.permutations(range(8), 2):
-            key = f'{players[i]}_vs_{players[j]}'
-            p1c, p2c, p1t, p2t = score_pair_on_windows(win, seq_codes[i], seq_codes[j])
+def split_unit(unit: dict, chunk_decks: int) -> list[dict]:
+    '''
+    Split a work unit into chunks of at most chunk_decks decks. Units with a
+    deck range (store batches, packed files) are split; compressed .npz
+    files cannot be sliced without decompressing them and stay whole.
+    '''
+    if 'start' not in unit or not chunk_decks or unit['stop'] - unit['start'] <= chunk_decks:
+        return [unit]
+    return [dict(unit, start=lo, stop=min(lo + chunk_decks, unit['stop']))
+            for lo in range(unit['start'], unit['stop'], chunk_decks)]
 
-            # totals
-            r = results[key]
-            r['p1_total_cards']  += p1c
-            r['p2_total_cards']  += p2c
-            r['p1_total_tricks'] += p1t
-            r['p2_total_tricks'] += p2t
+def load_unit_packed(unit: dict) -> np.ndarray:
+    '''
+    Packed decks of a ranged work unit as a zero-copy, read-only memmap. The
+    pages are shared by all workers through the OS page cache, so no deck
+    data is pickled between processes.
+    '''
+    if unit['kind'] == 'store':
+        return store.read_range(unit['dir'], unit['start'], unit['stop'])
+    return np.load(unit['path'], mmap_mode='r')[unit['start']:unit['stop']]
 
-            # Outcomes: cards
-            if p1c > p2c:
-                r['cards_p1_wins'] += 1
-            elif p2c > p1c:
-                r['cards_p2_wins'] += 1
-            else:
-                r['cards_ties'] += 1
+def generated_units(total_decks: int, batch_size: int, seed: int, first_batch_idx: int = 0,
+                    pairs: list[tuple[int, int]] | None = None, game: GameConfig = DEFAULT_GAME) -> list[dict]:
+    '''
+    Work units that are generated in memory instead of read from disk:
+    {'kind': 'generated', 'batch_idx', 'count', 'seed'}, one per batch, with
+    the same per-batch streams as data_gen.generate_to_store. If pairs is
+    given, only those (i, j) code pairs are scored for these units. Units of
+    a non-standard game carry it as 'game'.
+    '''
+    units = [{'kind': 'generated', 'batch_idx': first_batch_idx + b, 'count': min(batch_size, total_decks - lo), 'seed': seed}
+             for b, lo in enumerate(range(0, total_decks, batch_size))]
+    for unit in units:
+        if pairs is not None:
+            unit['pairs'] = pairs
+        if game != DEFAULT_GAME:
+            unit['game'] = game
+    return units
 
-            # Outcomes: tricks
-            if p1t > p2t:
-                r['tricks_p1_wins'] += 1
-            elif p2t > p1t:
-                r['tricks_p2_wins'] += 1
-            else:
-                r['tricks_ties'] += 1
+def counter_units(start: int, stop: int, seed: int, chunk_decks: int = CHUNK_DECKS,
+                  pairs: list[tuple[int, int]] | None = None, game: GameConfig = DEFAULT_GAME) -> list[dict]:
+    '''
+    Work units of decks start..stop-1 of the counter-based deck space of
+    seed (see data_gen.generate_deck_range): {'kind': 'counter', 'seed',
+    'start', 'stop'}, chunk_decks decks each. Any deck range can be
+    regenerated on its own, so no raw files are needed. pairs and game as
+    in generated_units.
+    '''
+    unit = {'kind': 'counter', 'seed': seed, 'start': start, 'stop': stop}
+    if pairs is not None:
+        unit['pairs'] = pairs
+    if game != DEFAULT_GAME:
+        unit['game'] = game
+    return split_unit(unit, chunk_decks)
 
-    return results, num_decks_in_file
+def with_rules(units: list[dict], rules) -> list[dict]:
+    '''
+    Marks units (or chunks) to be scored under the given scoring rules; like
+    'pairs', the key is only set when it is not the default.
+    '''
+    rules = check_rules(rules)
+    if rules != DEFAULT_RULES:
+        for unit in units:
+            unit['rules'] = rules
+    return units
 
+def load_unit_windows(unit: dict) -> np.ndarray:
+    '''
+    (N, 50) window codes of a work unit.
+    '''
+    if unit['kind'] in ('generated', 'counter'):
+        return deck_to_windows(load_unit_decks(unit), unit.get('game', DEFAULT_GAME))
+    if 'start' in unit:
+        return packed_to_windows(load_unit_packed(unit))
+    return load_windows(unit['path'])
 
-def run_simulation(raw_data_dir: str, output_csv_path: str):
+def load_unit_decks(unit: dict) -> np.ndarray:
     '''
-    Parallel over .npz files, aggregate head-to-head totals and outcome counts,
-    and save one CSV with totals and per-deck averages.
+    (N, 52) uint8 decks of a work unit.
     '''
-    file_list = [os.path.join(raw_data_dir, f) for f in os.listdir(raw_data_dir) if f.endswith('.npz')]
+    if unit['kind'] == 'generated':
+        return dg.generate_decks(unit['count'], dg.batch_seed(unit['seed'], unit['batch_idx']),
+                                 unit.get('game', DEFAULT_GAME))
+    if unit['kind'] == 'counter':
+        return dg.generate_deck_range(unit['start'], unit['stop'], unit['seed'], unit.get('game', DEFAULT_GAME))
+    if 'start' in unit:
+        return dg.unpack_decks(np.asarray(load_unit_packed(unit)))
+    return dg.load_decks(unit['path'])
+
+def process_unit(unit: dict, engine: str = 'batch') -> tuple[dict[str, Aggregate], int]:
+    '''
+    Scores one work unit (or chunk of one) with the given engine, under the
+    unit's 'rules' (default: DEFAULT_RULES).
+
+    Returns ({rule: aggregate}, num_decks_in_unit).
+    '''
+    load, score = ENGINES[engine]
+    game = unit.get('game', DEFAULT_GAME)
+    rules = unit.get('rules', DEFAULT_RULES)
+    data = load(unit)
+    if len(data) == 0:
+        return empty_rule_results(rules, game), 0
+    return score(data, unit.get('pairs'), game, rules), len(data)
+
+def empty_rule_results(rules=DEFAULT_RULES, game: GameConfig = DEFAULT_GAME) -> dict[str, Aggregate]:
+    return {rule: Aggregate(game) for rule in rules}
+
+def merge_rule_results(final_results: dict[str, Aggregate], results: dict[str, Aggregate]) -> dict[str, Aggregate]:
+    '''
+    Adds the per-rule aggregates of results into final_results (in place).
+    '''
+    for rule, agg in results.items():
+        final_results[rule].merge(agg)
+    return final_results
+
+
+def rule_csv_path(output_csv_path: str, rule: str) -> str:
+    '''
+    CSV of one scoring rule: output_csv_path for the pile rule,
+    <stem>_<rule>.csv next to it for the others
+    (results/scoring_results.csv -> results/scoring_results_legacy.csv)
+    '''
+    if rule == 'pile':
+        return output_csv_path
+    return f'{os.path.splitext(output_csv_path)[0]}_{rule}.csv'
+
+def write_results_csv(results: Aggregate, output_csv_path: str):
+    '''
+    Writes the aggregate as one CSV row per pair, with totals, outcome
+    counts, per-deck rates (over the decks each pair was scored on) and the
+    half-width of each rate's 95% Wilson interval ('<rate>_ci'). The
+    aggregate itself and the margin histograms go next to it (see
+    aggregate.aggregate_path and margins.margins_path).
+    '''
+    results.write_csv(output_csv_path)
+    results.save(aggregate_path(output_csv_path))
+    save_margins(results, margins_path(output_csv_path))
+
 
-    if not file_list:
-        print(f'No .npz files found in {raw_data_dir}. Please generate the data first.')
+# color-complement symmetry
+# Swapping red and black maps window code w to 7 - w, so pair (a, b) on a
+# deck scores exactly like (7 - a, 7 - b) on the complemented deck. Decks are
+# uniform, so the two pairs of each orbit have the same distribution.
+# (Two-color games only; with seq_len L the mirror code is 2**L - 1 - w.)
+SYMMETRY_MODES = ('half', 'double')
+
+def mirror_pair(i: int, j: int, game: GameConfig = DEFAULT_GAME) -> tuple[int, int]:
+    '''
+    The other pair of (i, j)'s complement orbit
+    '''
+    top = game.n_players - 1
+    return top - i, top - j
+
+def orbit_pairs(game: GameConfig = DEFAULT_GAME) -> list[tuple[int, int]]:
+    '''
+    One representative per complement orbit: the 28 pairs with player1 in
+    000..011 (the mirror of each has player1 in 100..111).
+    '''
+    return [(i, j) for i, j in get_pairs(game) if i < game.n_players // 2]
+
+def symmetry_pairs(symmetry: str | None, game: GameConfig = DEFAULT_GAME) -> list[tuple[int, int]] | None:
+    '''
+    Pairs to score per deck for a symmetry mode (None = all 56)
+    '''
+    if symmetry not in (None,) + SYMMETRY_MODES:
+        raise ValueError(f'unknown symmetry mode {symmetry!r}, expected one of {SYMMETRY_MODES}')
+    if symmetry is not None and game.n_colors != 2:
+        raise ValueError('the color-complement symmetry needs a two-color game')
+    return orbit_pairs(game) if symmetry == 'half' else None
+
+def apply_symmetry(final_results: Aggregate, symmetry: str | None) -> Aggregate:
+    '''
+    Rebuilds all 56 rows from what a symmetry mode scored. The mirror of
+    pair (i, j) is (7 - i, 7 - j), so the mirrored aggregate is the data
+    with both player axes reversed.
+
+    'half': only the orbit representatives were scored (half the work);
+    each mirror row is a copy of its representative's row.
+    'double': all pairs were scored, which is every representative on the
+    deck and on its complement; both rows of an orbit get the pooled counts
+    (two samples per deck at the same cost) but keep their decks, since a
+    deck and its complement are one paired observation, not two independent
+    ones (see Aggregate).
+    '''
+    if symmetry is None:
+        return final_results
+    data = final_results.data
+    mirrored = data[::-1, ::-1]
+    if symmetry == 'double':
+        pooled = Aggregate(final_results.game, data + mirrored)
+        pooled['decks'][...] = final_results['decks']
+        return pooled
+    results = final_results.copy()
+    mirror_rows = np.arange(final_results.game.n_players) >= final_results.game.n_players // 2
+    results.data[mirror_rows] = mirrored[mirror_rows]
+    return results
+
+def orbit_differences(final_results: Aggregate, total_decks: int, game: GameConfig = DEFAULT_GAME) -> 'pd.DataFrame':
+    '''
+    Sanity check of the symmetry on fully scored results: for every orbit
+    and rate, the measured difference between the two pairs' rates and its
+    z-score (difference / standard error of a difference of two rates).
+    '''
+    import pandas as pd
+
+    n = max(total_decks, 1)
+    rows = []
+    for i, j in orbit_pairs(game):
+        mi, mj = mirror_pair(i, j, game)
+        for rate, count in RATE_COUNTS.items():
+            p_rep, p_mirror = final_results[count][i, j] / n, final_results[count][mi, mj] / n
+            se = math.sqrt((p_rep * (1 - p_rep) + p_mirror * (1 - p_mirror)) / n)
+            rows.append({'pair': pair_key(i, j, game), 'mirror': pair_key(mi, mj, game), 'rate': rate,
+                         'diff': p_rep - p_mirror, 'z': (p_rep - p_mirror) / se if se > 0 else 0.0})
+    return pd.DataFrame(rows)
+
+def report_orbit_differences(final_results: Aggregate, total_decks: int, game: GameConfig = DEFAULT_GAME) -> 'pd.DataFrame':
+    '''
+    Prints a summary of orbit_differences and returns it.
+    '''
+    diffs = orbit_differences(final_results, total_decks, game)
+    worst = diffs.reindex(diffs['z'].abs().sort_values(ascending=False).index).head(3)
+    print(f'[symmetry] Within-orbit differences over {total_decks} decks: '
+          f'max |diff| {diffs["diff"].abs().max():.6f}, max |z| {diffs["z"].abs().max():.2f}')
+    print(worst.to_string(index=False))
+    return diffs
+
+def finish_results(final_results: dict[str, Aggregate], total_decks: int, output_csv_path: str, metrics=None,
+                   symmetry: str | None = None, orbit_check: bool = False, game: GameConfig = DEFAULT_GAME) -> Aggregate:
+    '''
+    Shared tail of the run_* functions: optional orbit check (of the first
+    rule), rebuilding the rows of a symmetry mode, and writing one CSV per
+    scoring rule (see rule_csv_path).
+
+    Returns the aggregate written to output_csv_path (the pile rule), for
+    drawing the heatmaps without reading it back.
+    '''
+    if orbit_check:
+        if symmetry == 'half':
+            print('[symmetry] No orbit check in half mode: mirror pairs are not measured.')
+        elif game.n_colors != 2:
+            print('[symmetry] No orbit check: the color-complement symmetry needs a two-color game.')
+        else:
+            report_orbit_differences(next(iter(final_results.values())), total_decks, game)
+    with maybe_stage(metrics, 'scoring/write_csv'):
+        written = {rule: apply_symmetry(results, symmetry) for rule, results in final_results.items()}
+        for rule, results in written.items():
+            write_results_csv(results, rule_csv_path(output_csv_path, rule))
+    return written['pile']
+
+
+# engine name -> (loader, scorer)
+# scorers take (data, pairs, game, rules) and return {rule: aggregate}
+ENGINES = {
+    'batch': (load_unit_windows, score_windows_all_rules),  # vectorized
+    'loop': (load_unit_decks, score_decks_rules),           # per-deck reference kernel
+}
+
+_PROFILER = None  # per-worker cProfile.Profile when profiling is on
+
+def process_chunk(task: tuple[int, dict, str, str | None]) -> tuple[int, dict[str, Aggregate], int, dict]:
+    '''
+    Pool worker: loads and scores one chunk with the given engine. If
+    profile_dir is set, the worker's cProfile stats (cumulative over its
+    chunks) are dumped to profile_dir/worker_<pid>.prof after each chunk.
+
+    Returns (chunk_id, {rule: aggregate}, num_decks, stats) where stats holds the
+    worker pid, start time, load and compute seconds and peak RSS.
+    '''
+    global _PROFILER
+    chunk_id, chunk, engine, profile_dir = task
+    load, score = ENGINES[engine]
+    game = chunk.get('game', DEFAULT_GAME)
+    rules = chunk.get('rules', DEFAULT_RULES)
+
+    if profile_dir and _PROFILER is None:
+        import cProfile
+        _PROFILER = cProfile.Profile()
+    if profile_dir:
+        _PROFILER.enable()
+
+    started = time.time()
+    t0 = time.perf_counter()
+    data = load(chunk)
+    t1 = time.perf_counter()
+    results = score(data, chunk.get('pairs'), game, rules) if len(data) else empty_rule_results(rules, game)
+    t2 = time.perf_counter()
+
+    if profile_dir:
+        _PROFILER.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        _PROFILER.dump_stats(os.path.join(profile_dir, f'worker_{os.getpid()}.prof'))
+
+    stats = {'pid': os.getpid(), 'start': started, 'load_s': t1 - t0, 'compute_s': t2 - t1, 'rss_mb': peak_rss_mb()}
+    return chunk_id, results, len(data), stats
+
+PREFETCH_DEPTH = 2  # loaded chunks a worker keeps ready while it scores, 0 = load then score
+
+def prefetch_worker(tasks, results, engine: str, profile_dir: str | None, depth: int) -> None:
+    '''
+    Worker process of iter_scored_chunks with prefetch: a background thread
+    takes (chunk_id, chunk) tasks off the shared queue and loads them (file
+    reads, zlib decompression, window decoding or generation, which mostly
+    release the GIL) into a local queue of at most depth chunks, while the
+    main thread scores the chunk before. A None task ends the worker.
+
+    Puts (chunk_id, {rule: aggregate}, num_decks, stats) on results for every
+    chunk, with the stats of process_chunk plus 'wait_s': how long the
+    scorer waited for the chunk to be loaded (the load time not hidden
+    behind compute). On an error it puts ('error', traceback) and stops.
+    '''
+    load, score = ENGINES[engine]
+    loaded = queue.Queue(maxsize=max(1, depth))
+
+    def loader():
+        while True:
+            task = tasks.get()
+            if task is None:
+                loaded.put(None)
+                return
+            k, chunk = task
+            t0 = time.perf_counter()
+            try:
+                loaded.put((k, chunk, load(chunk), time.perf_counter() - t0))
+            except BaseException:
+                loaded.put(('error', traceback.format_exc()))
+                return
+
+    threading.Thread(target=loader, daemon=True).start()
+    profiler = None
+    if profile_dir:
+        import cProfile
+        profiler = cProfile.Profile()  # profiles the scoring thread
+    while True:
+        t0 = time.perf_counter()
+        item = loaded.get()
+        if item is None:
+            break
+        if item[0] == 'error':
+            results.put(item)
+            return
+        started = time.time()
+        t1 = time.perf_counter()
+        k, chunk, data, load_s = item
+        game = chunk.get('game', DEFAULT_GAME)
+        rules = chunk.get('rules', DEFAULT_RULES)
+        try:
+            if profiler:
+                profiler.enable()
+            chunk_results = score(data, chunk.get('pairs'), game, rules) if len(data) else empty_rule_results(rules, game)
+            if profiler:
+                profiler.disable()
+        except BaseException:
+            results.put(('error', traceback.format_exc()))
+            return
+        t2 = time.perf_counter()
+        stats = {'pid': os.getpid(), 'start': started, 'load_s': load_s, 'wait_s': t1 - t0,
+                 'compute_s': t2 - t1, 'rss_mb': peak_rss_mb()}
+        results.put((k, chunk_results, len(data), stats))
+    if profiler:
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f'worker_{os.getpid()}.prof'))
+
+def iter_prefetched(chunks: list[dict], engine: str, num_processes: int, profile_dir: str | None, depth: int):
+    '''
+    Runs prefetch_worker on num_processes processes over a shared task
+    queue (so the chunks are still handed out as workers free up) and
+    yields their (chunk_id, {rule: aggregate}, num_decks, stats) results as
+    they arrive. Raises if a worker fails or dies.
+    '''
+    tasks, results = multiprocessing.Queue(), multiprocessing.Queue()
+    for k, chunk in enumerate(chunks):
+        tasks.put((k, chunk))
+    for _ in range(num_processes):
+        tasks.put(None)
+    procs = [multiprocessing.Process(target=prefetch_worker, args=(tasks, results, engine, profile_dir, depth), daemon=True)
+             for _ in range(num_processes)]
+    for proc in procs:
+        proc.start()
+    try:
+        for _ in range(len(chunks)):
+            while True:
+                try:
+                    item = results.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    dead = [proc.exitcode for proc in procs if proc.exitcode not in (None, 0)]
+                    if dead:
+                        raise RuntimeError(f'a scoring worker died with exit code {dead[0]}')
+            if item[0] == 'error':
+                raise RuntimeError(f'scoring worker failed:\n{item[1]}')
+            yield item
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+
+def iter_scored_chunks(chunks: list[dict], engine: str = 'batch', workers: int | None = None,
+                       metrics=None, progress: bool = True, profile_dir: str | None = None,
+                       prefetch: int = PREFETCH_DEPTH):
+    '''
+    Scores chunks on worker processes and yields (chunk_id, {rule: aggregate},
+    num_decks) as soon as each chunk finishes, so the caller can reduce
+    results as they arrive.
+
+    progress: live line with the throughput of every chunk.
+    metrics: a metrics.Metrics that receives the 'scoring/pool' stage (pool
+    startup, per-worker load vs compute time, idle time, reduce time, and
+    how much of the load time was hidden behind compute).
+    profile_dir: turn on the per-worker cProfile hook (see process_chunk).
+    prefetch: every worker loads up to this many chunks ahead on a
+    background thread while it scores (see prefetch_worker); 0 uses a
+    process pool that loads and then scores each chunk (process_chunk).
+    '''
+    if not chunks:
         return
+    num_processes = max(1, min(workers or cpu_count(), len(chunks)))
+    print(f'Scoring {len(chunks)} chunks on {num_processes} processes'
+          + (f' (prefetch {prefetch}).' if prefetch else '.'))
 
-    num_processes = cpu_count()
-    print(f'Using {num_processes} processes for parallel execution.')
+    rates = []
+    per_worker = {}
+    n_total = 0
+    reduce_s = 0.0
+    first_start = None
+    t_pool = time.time()
+    t0 = time.perf_counter()
+    with Pool(processes=num_processes) if not prefetch else nullcontext() as pool:
+        if prefetch:
+            scored = iter_prefetched(chunks, engine, num_processes, profile_dir, prefetch)
+        else:
+            scored = pool.imap_unordered(process_chunk, [(k, chunk, engine, profile_dir) for k, chunk in enumerate(chunks)])
+        for done, (k, results, n, st) in enumerate(scored, 1):
+            wait_s = st.get('wait_s', st['load_s'])
+            busy = wait_s + st['compute_s']
+            rate = n / busy if busy > 0 else 0.0
+            rates.append(rate)
+            n_total += n
+            first_start = st['start'] if first_start is None else min(first_start, st['start'])
+            w = per_worker.setdefault(str(st['pid']), {'chunks': 0, 'decks': 0, 'load_s': 0.0, 'wait_s': 0.0,
+                                                       'compute_s': 0.0, 'rss_mb': 0.0})
+            w['chunks'] += 1
+            w['decks'] += n
+            w['load_s'] += st['load_s']
+            w['wait_s'] += wait_s
+            w['compute_s'] += st['compute_s']
+            w['rss_mb'] = max(w['rss_mb'], st['rss_mb'])
+            if progress:
+                elapsed = time.perf_counter() - t0
+                print(f'\r[score] chunk {done}/{len(chunks)}: {n} decks in {busy:.3f}s ({rate:,.0f} decks/s), '
+                      f'{n_total:,} decks in {elapsed:.1f}s', end='', flush=True)
+            t_yield = time.perf_counter()
+            yield k, results, n
+            reduce_s += time.perf_counter() - t_yield
+    wall = time.perf_counter() - t0
+    if progress:
+        print()
+    load_s = sum(w['load_s'] for w in per_worker.values())
+    wait_s = sum(w['wait_s'] for w in per_worker.values())
+    compute_s = sum(w['compute_s'] for w in per_worker.values())
+    print(f'[score] {n_total} decks in {wall:.2f}s ({n_total / max(wall, 1e-9):,.0f} decks/s overall); '
+          f'per chunk min/median/max {min(rates):,.0f}/{np.median(rates):,.0f}/{max(rates):,.0f} decks/s')
+    if prefetch:
+        print(f'[score] load {load_s:.2f}s, {load_s - wait_s:.2f}s of it hidden behind compute '
+              f'({(load_s - wait_s) / max(load_s, 1e-9):.0%})')
+
+    if metrics is not None:
+        for w in per_worker.values():
+            w['idle_s'] = max(0.0, wall - w['wait_s'] - w['compute_s'])
+        metrics.add('scoring/pool', seconds=wall, decks=n_total, chunks=len(chunks), workers=num_processes,
+                    pool_startup_s=max(0.0, first_start - t_pool), load_s=load_s, compute_s=compute_s,
+                    prefetch=prefetch, load_wait_s=wait_s, load_hidden_s=load_s - wait_s,
+                    reduce_s=reduce_s, idle_s=max(0.0, num_processes * wall - wait_s - compute_s),
+                    chunk_decks_per_s={'min': min(rates), 'median': float(np.median(rates)), 'max': max(rates)},
+                    per_worker=per_worker)
+        entry = metrics.stages['scoring/pool']
+        entry['load_hidden_frac'] = entry['load_hidden_s'] / entry['load_s'] if entry['load_s'] else 0.0
+        entry['peak_worker_rss_mb'] = max([entry.get('peak_worker_rss_mb', 0.0)] + [w['rss_mb'] for w in per_worker.values()])
 
-    with Pool(processes=num_processes) as pool:
-        processed_results = pool.map(process_file_optimized, file_list)
+# checkpoints of long runs
+CHECKPOINT_EVERY = 20  # chunks between two saves of the running aggregate
+
+def chunk_plan_id(chunks: list[dict]) -> str:
+    '''
+    Fingerprint of a list of chunks (and of the scoring version): a
+    checkpoint is only resumed by a run that would score the same chunks.
+    '''
+    keys = [unit_fingerprint(c) + f':{c.get("start")}:{c.get("stop")}' if c['kind'] not in ('generated', 'counter')
+            else json.dumps(c, sort_keys=True, default=str) for c in chunks]
+    return f'v{SCORE_VERSION}:' + hashlib.sha256('\n'.join(keys).encode()).hexdigest()
+
+def save_checkpoint(path: str, plan_id: str, done: list[int], results: dict[str, Aggregate], num_decks: int) -> None:
+    '''
+    Atomically saves the running aggregate and the ids of the chunks in it.
+    '''
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_json_atomic(path, {'plan_id': plan_id, 'done': sorted(done), 'num_decks': num_decks,
+                             'results': {rule: agg.to_json() for rule, agg in results.items()}})
+
+def load_checkpoint(path: str, plan_id: str) -> tuple[set, dict[str, Aggregate], int] | None:
+    '''
+    (done chunk ids, results, num_decks) of a checkpoint of the same chunk
+    plan, or None if there is none.
+    '''
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            cp = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cp.get('plan_id') != plan_id:
+        print(f'[checkpoint] {path} belongs to a different run, starting over.')
+        return None
+    results = {rule: Aggregate.from_json(agg) for rule, agg in cp['results'].items()}
+    return set(cp['done']), results, cp['num_decks']
 
+def clear_checkpoint(path: str | None) -> None:
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def reduce_chunks(chunks: list[dict], engine: str = 'batch', workers: int | None = None,
+                  metrics=None, progress: bool = True, profile_dir: str | None = None,
+                  game: GameConfig = DEFAULT_GAME, checkpoint_path: str | None = None,
+                  checkpoint_every: int = CHECKPOINT_EVERY, resume: bool = False,
+                  rules=DEFAULT_RULES, prefetch: int = PREFETCH_DEPTH) -> tuple[dict[str, Aggregate], int]:
+    '''
+    Scores chunks with iter_scored_chunks and reduces them into one
+    aggregate per scoring rule as they arrive (the chunks carry the rules,
+    see with_rules).
+
+    checkpoint_path: save the running aggregate there every checkpoint_every
+    chunks (and when the last chunk is in), atomically.
+    resume: continue from the checkpoint of an interrupted run of the same
+    chunks, scoring only the chunks that are not in it yet.
+
+    Returns ({rule: aggregate}, num_decks).
+    '''
+    final_results = empty_rule_results(rules, game)
     total_decks = 0
-    # initialize dict (aggregator)
-    final_results = {
-        f'{p1}_vs_{p2}': {
-            'p1_total_cards': 0, 'p2_total_cards': 0,
-            'p1_total_tricks': 0, 'p2_total_tricks': 0,
-            'cards_p1_wins': 0, 'cards_p2_wins': 0, 'cards_ties': 0,
-            'tricks_p1_wins': 0, 'tricks_p2_wins': 0, 'tricks_ties': 0,
-        }
-        for p1, p2 in itertools.permutations(get_players(), 2)
-    }
+    done = set()
+    plan_id = chunk_plan_id(chunks) if checkpoint_path else None
+    if resume:
+        cp = load_checkpoint(checkpoint_path, plan_id)
+        if cp is not None:
+            done, saved, total_decks = cp
+            merge_rule_results(final_results, saved)
+            print(f'[checkpoint] Resuming: {len(done)} of {len(chunks)} chunks ({total_decks} decks) already scored.')
 
-    # reducing results of files through aggregation
-    for single_file_results, n_in_file in processed_results:
-        total_decks += n_in_file
-        if not single_file_results:
-            continue
-        for combo, scores in single_file_results.items():
-            agg = final_results[combo]
-            for k, v in scores.items():
-                agg[k] += v
-
-    # building rows of csv files
-    rows = []
-    for combo, s in final_results.items():
-        p1, p2 = combo.split('_vs_')
-        # calculating probabilities (avgs) for results of combs
-        denom = max(total_decks, 1)
-        rows.append({
-            'player1': p1, 'player2': p2,
-            'p1_cards': s['p1_total_cards'],  'p2_cards': s['p2_total_cards'],
-            'p1_tricks': s['p1_total_tricks'],'p2_tricks': s['p2_total_tricks'],
-
-            'cards_p1_wins': s['cards_p1_wins'],
-            'cards_p2_wins': s['cards_p2_wins'],
-            'cards_ties': s['cards_ties'],
-
-            'tricks_p1_wins': s['tricks_p1_wins'],
-            'tricks_p2_wins': s['tricks_p2_wins'],
-            'tricks_ties': s['tricks_ties'],
-
-            # Optional rates (per deck)
-            'cards_p1_win_rate': s['cards_p1_wins'] / denom,
-            'cards_p2_win_rate': s['cards_p2_wins'] / denom,
-            'cards_tie_rate':    s['cards_ties']    / denom,
-
-            'tricks_p1_win_rate': s['tricks_p1_wins'] / denom,
-            'tricks_p2_win_rate': s['tricks_p2_wins'] / denom,
-            'tricks_tie_rate':    s['tricks_ties']    / denom,
-        })
+    todo = [k for k in range(len(chunks)) if k not in done]
+    since_save = 0
+    for r, chunk_results, n_in_chunk in iter_scored_chunks([chunks[k] for k in todo], engine, workers,
+                                                            metrics, progress, profile_dir, prefetch):
+        total_decks += n_in_chunk
+        merge_rule_results(final_results, chunk_results)
+        done.add(todo[r])
+        since_save += 1
+        if checkpoint_path and (since_save >= checkpoint_every or len(done) == len(chunks)):
+            with maybe_stage(metrics, 'scoring/checkpoint'):
+                save_checkpoint(checkpoint_path, plan_id, list(done), final_results, total_decks)
+            since_save = 0
+    return final_results, total_decks
+
+
+def run_simulation(raw_data_dir: str, output_csv_path: str, engine: str = 'batch',
+                   workers: int | None = None, chunk_decks: int = CHUNK_DECKS,
+                   metrics=None, progress: bool = True, profile_dir: str | None = None,
+                   symmetry: str | None = None, orbit_check: bool = False,
+                   checkpoint_path: str | None = None, resume: bool = False, rules=DEFAULT_RULES,
+                   prefetch: int = PREFETCH_DEPTH) -> tuple[int, Aggregate] | None:
+    '''
+    Parallel over fixed-size deck ranges of the raw data (deck store and loose
+    batch files), aggregate head-to-head totals and outcome counts as chunks
+    finish, and save one CSV with totals and per-deck averages.
+
+    engine: 'batch' (vectorized, default) or 'loop' (per-deck reference kernel).
+    workers: number of processes (default cpu_count()).
+    chunk_decks: decks per worker task.
+    metrics, progress, profile_dir, prefetch: see iter_scored_chunks.
+    symmetry: None, 'half' or 'double', see apply_symmetry.
+    orbit_check: print the measured within-orbit differences.
+    checkpoint_path, resume: see reduce_chunks; the checkpoint is removed
+    once the CSV is written.
+    rules: scoring rules evaluated in the same pass over the decks (see
+    SCORING_RULES), one CSV each (see rule_csv_path).
+
+    Returns (total decks, aggregate of the CSV), None if there are no decks.
+    '''
+    units = list_units(raw_data_dir)
+
+    if not units:
+        print(f'No decks found in {raw_data_dir}. Please generate the data first.')
+        return
 
-    df = pd.DataFrame(rows)
-    df.to_csv(output_csv_path, index=False)
+    chunks = [c for unit in merge_store_units(units) for c in split_unit(unit, chunk_decks)]
+    pairs = symmetry_pairs(symmetry)
+    if pairs is not None:
+        for chunk in chunks:
+            chunk['pairs'] = pairs
+    rules = check_rules(rules)
+    with_rules(chunks, rules)
+
+    # reducing results of chunks through aggregation, as they arrive
+    final_results, total_decks = reduce_chunks(chunks, engine, workers, metrics, progress, profile_dir,
+                                               checkpoint_path=checkpoint_path, resume=resume, rules=rules,
+                                               prefetch=prefetch)
+
+    results = finish_results(final_results, total_decks, output_csv_path, metrics, symmetry, orbit_check)
+    clear_checkpoint(checkpoint_path)
     print(f'Results saved to {output_csv_path}\nTotal decks processed: {total_decks}')
-    return total_decks
+    return total_decks, results
+
+
+def run_streaming(total_decks: int, output_csv_path: str, batch_size: int = 10_000, seed: int = 12345,
+                  workers: int | None = None, metrics=None, progress: bool = True, profile_dir: str | None = None,
+                  symmetry: str | None = None, orbit_check: bool = False, game: GameConfig = DEFAULT_GAME,
+                  checkpoint_path: str | None = None, resume: bool = False, rules=DEFAULT_RULES,
+                  first_deck: int | None = None, prefetch: int = PREFETCH_DEPTH) -> tuple[int, Aggregate]:
+    '''
+    Fused generate-and-score: each worker generates a batch from its seed,
+    scores it in memory and returns only the aggregate, so no raw deck files
+    are written. Saves the same CSV as run_simulation.
+    (In the metrics, a chunk's load time is its generation time.)
+    game: any game.GameConfig; the file and store runners only handle the
+    standard game, this is how other games are sampled.
+    checkpoint_path, resume, rules, prefetch: see run_simulation.
+    first_deck: score decks first_deck..first_deck+total_decks-1 of the
+    counter-based deck space of seed (see counter_units) instead of the
+    batch streams, in batch_size chunks.
+
+    Returns (decks scored, aggregate of the CSV).
+    '''
+    rules = check_rules(rules)
+    pairs = symmetry_pairs(symmetry, game)
+    if first_deck is None:
+        units = generated_units(total_decks, batch_size, seed, pairs=pairs, game=game)
+        print(f'Streaming {total_decks} decks in {len(units)} batches.')
+    else:
+        units = counter_units(first_deck, first_deck + total_decks, seed, batch_size, pairs=pairs, game=game)
+        print(f'Streaming decks {first_deck}..{first_deck + total_decks - 1} of seed {seed} in {len(units)} chunks.')
+    with_rules(units, rules)
+
+    final_results, n_done = reduce_chunks(units, 'batch', workers, metrics, progress, profile_dir, game,
+                                          checkpoint_path=checkpoint_path, resume=resume, rules=rules, prefetch=prefetch)
+
+    results = finish_results(final_results, n_done, output_csv_path, metrics, symmetry, orbit_check, game)
+    clear_checkpoint(checkpoint_path)
+    print(f'Results saved to {output_csv_path}\nTotal decks processed: {n_done}')
+    return n_done, results
+
+
+def run_until_converged(target_ci: float, output_csv_path: str, batch_size: int = 10_000, seed: int = 12345,
+                        max_decks: int | None = None, workers: int | None = None,
+                        metrics=None, progress: bool = True, profile_dir: str | None = None,
+                        game: GameConfig = DEFAULT_GAME, prefetch: int = PREFETCH_DEPTH) -> tuple[int, Aggregate]:
+    '''
+    Convergence-driven streaming: generates and scores rounds of in-memory
+    batches until the 95% Wilson interval of every win/tie rate, under both
+    rules, has a half-width of at most target_ci. Pairs that are settled
+    stop being scored; later rounds only score the pairs that still need
+    samples, all on the same deck stream (so each pair's decks are a prefix
+    of the stream). Each round is sized from the current worst interval.
+    Stops early at max_decks per pair if given.
+
+    Saves the CSV (with per-pair deck counts behind the rates and CIs) and
+    returns (the largest number of decks any pair was scored on, its
+    aggregate).
+    '''
+    pairs = get_pairs(game)
+    final_results = Aggregate(game)
+    pair_decks = final_results['decks']
+    active = list(pairs)
+    next_batch = 0
+    round_decks = batch_size * max(1, workers or cpu_count())
+
+    while active:
+        if max_decks is not None:
+            round_decks = min(round_decks, max_decks - int(pair_decks[active[0]]))
+        units = generated_units(round_decks, batch_size, seed, first_batch_idx=next_batch, pairs=active, game=game)
+        next_batch += len(units)
+        for _, batch_results, _ in iter_scored_chunks(units, 'batch', workers, metrics, progress, profile_dir, prefetch):
+            final_results.merge(batch_results['pile'])
 
+        widths = final_results.max_ci_halfwidth()
+        active_widths = [widths[pair] for pair in active]
+        active = [pair for pair in active if widths[pair] > target_ci]
+        n_now = int(pair_decks.max())
+        print(f'[converge] {n_now} decks: {len(pairs) - len(active)}/{len(pairs)} pairs within +/-{target_ci}, '
+              f'widest +/-{max(active_widths):.5f}')
 
+        if not active:
+            break
+        if max_decks is not None and n_now >= max_decks:
+            print(f'[converge] Stopping at max_decks={max_decks} with {len(active)} pairs above the target.')
+            break
+        # CI half-width shrinks like 1/sqrt(n): estimate the decks still needed
+        worst = max(widths[pair] for pair in active)
+        needed = n_now * ((worst / target_ci) ** 2 - 1)
+        round_decks = int(min(max(needed * 1.1, batch_size), 4 * n_now))
+
+    with maybe_stage(metrics, 'scoring/write_csv'):
+        write_results_csv(final_results, output_csv_path)
+    scored = pair_decks[tuple(np.array(pairs).T)]
+    print(f'Results saved to {output_csv_path}\nDecks per pair: {scored.min()} to {scored.max()}')
+    return int(scored.max()), final_results
+
+
+# incremental scoring
+SCORE_VERSION = 4  # bump when the scoring rules or the aggregate layout change, invalidates all partials
+PARTIAL_SUFFIX = '.partial.json'
+
+def partial_path(unit: dict) -> str:
+    '''
+    Path of the partial aggregate of a work unit: next to a loose batch
+    file, or in partials/ next to the deck store.
+    '''
+    if unit['kind'] == 'store':
+        return os.path.join(unit['dir'], 'partials', f'batch_{unit["batch_idx"]}.json')
+    return unit['path'] + PARTIAL_SUFFIX
+
+def unit_fingerprint(unit: dict) -> str:
+    '''
+    Cheap fingerprint of a work unit and of the scoring version; a partial
+    aggregate is only reused if its fingerprint matches. Loose files use
+    (name, size, mtime); store batches use (store id, batch, deck range),
+    since the store is append-only. Units scored on a subset of the pairs
+    (symmetry 'half') or under other scoring rules get their own fingerprint.
+    '''
+    subset = ':half' if unit.get('pairs') is not None else ''
+    if 'rules' in unit:
+        subset += ':' + '+'.join(unit['rules'])
+    if unit['kind'] == 'store':
+        return f'v{SCORE_VERSION}{subset}:store:{unit["store_id"]}:{unit["batch_idx"]}:{unit["start"]}:{unit["stop"]}'
+    st = os.stat(unit['path'])
+    return f'v{SCORE_VERSION}{subset}:{os.path.basename(unit["path"])}:{st.st_size}:{st.st_mtime_ns}'
+
+def write_json_atomic(path: str, obj) -> None:
+    '''
+    Write obj as JSON to path via a temporary file and os.replace, so readers
+    never see a half-written file.
+    '''
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+def save_partial(unit: dict, fingerprint: str, results: dict[str, Aggregate], num_decks: int) -> None:
+    '''
+    Stores the partial aggregates (one per scoring rule) of a work unit
+    (atomically).
+    '''
+    path = partial_path(unit)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_json_atomic(path, {'fingerprint': fingerprint, 'num_decks': num_decks,
+                             'results': {rule: agg.to_json() for rule, agg in results.items()}})
+
+def load_partial(unit: dict) -> tuple[dict[str, Aggregate], int] | None:
+    '''
+    Returns ({rule: aggregate}, num_decks) from the partial aggregate of a
+    work unit, or None if it is missing or stale.
+    '''
+    path = partial_path(unit)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            partial = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if partial.get('fingerprint') != unit_fingerprint(unit):
+        return None
+    return {rule: Aggregate.from_json(agg) for rule, agg in partial['results'].items()}, partial['num_decks']
+
+def run_incremental(raw_data_dir: str, output_csv_path: str,
+                    workers: int | None = None, chunk_decks: int = CHUNK_DECKS,
+                    metrics=None, progress: bool = True, profile_dir: str | None = None,
+                    symmetry: str | None = None, orbit_check: bool = False, rules=DEFAULT_RULES,
+                    prefetch: int = PREFETCH_DEPTH) -> tuple[int, int, Aggregate | None]:
+    '''
+    Incremental run_simulation: only work units without a valid partial
+    aggregate are scored (split into chunks like run_simulation), each one's
+    partial is saved once all its chunks are in, then all partials are merged
+    and the CSV is rewritten. If every unit already has a valid partial and
+    the CSV exists, nothing is done.
+    symmetry, orbit_check, rules, prefetch: see run_simulation. A partial holds the
+    aggregates of all the rules it was scored under.
+
+    Returns (total_decks, num_units_scored, aggregate of the CSV), the
+    aggregate None if there are no decks.
+    '''
+    units = list_units(raw_data_dir)
+
+    if not units:
+        print(f'No decks found in {raw_data_dir}. Please generate the data first.')
+        return 0, 0, None
+    pairs = symmetry_pairs(symmetry)
+    if pairs is not None:
+        for unit in units:
+            unit['pairs'] = pairs
+    rules = check_rules(rules)
+    with_rules(units, rules)
+
+    final_results = empty_rule_results(rules)
+    total_decks = 0
+    stale = []
+    with maybe_stage(metrics, 'scoring/load_partials'):
+        for unit in units:
+            partial = load_partial(unit)
+            if partial is None:
+                stale.append(unit)
+                continue
+            merge_rule_results(final_results, partial[0])
+            total_decks += partial[1]
+
+    if not stale and os.path.exists(output_csv_path):
+        print(f'All {len(units)} batches already scored; {output_csv_path} is up to date.')
+        return total_decks, 0, apply_symmetry(final_results['pile'], symmetry)
+
+    print(f'{len(stale)} of {len(units)} batches need scoring.')
+    chunks, owner = [], []
+    for u, unit in enumerate(stale):
+        for chunk in split_unit(unit, chunk_decks):
+            chunks.append(chunk)
+            owner.append(u)
+    fingerprints = [unit_fingerprint(unit) for unit in stale]
+    pending = [owner.count(u) for u in range(len(stale))]
+    unit_results = [empty_rule_results(rules) for _ in stale]
+    unit_decks = [0] * len(stale)
+
+    for k, chunk_results, n_in_chunk in iter_scored_chunks(chunks, 'batch', workers, metrics, progress, profile_dir, prefetch):
+        u = owner[k]
+        merge_rule_results(unit_results[u], chunk_results)
+        unit_decks[u] += n_in_chunk
+        pending[u] -= 1
+        if pending[u] == 0:
+            save_partial(stale[u], fingerprints[u], unit_results[u], unit_decks[u])
+            merge_rule_results(final_results, unit_results[u])
+            total_decks += unit_decks[u]
+            unit_results[u] = None
+
+    results = finish_results(final_results, total_decks, output_csv_path, metrics, symmetry, orbit_check)
+    print(f'Results saved to {output_csv_path}\nTotal decks processed: {total_decks}')
+    return total_decks, len(stale), results
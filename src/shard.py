@@ -0,0 +1,413 @@
+'''
+Sharded scoring across processes or hosts that share a directory.
+
+    uv run python -m src.shard plan --decks 1000000000 --shards 64 --out shards/manifest.json
+    uv run python -m src.shard plan --counter-decks 1000000000 --shards 64 --out shards/manifest.json
+    uv run python -m src.shard plan --raw-dir ./raw_data --shards 8 --out shards/manifest.json
+    uv run python -m src.shard work shards/manifest.json 3 --out-dir shards/     # on any host
+    uv run python -m src.shard merge shards/ --manifest shards/manifest.json --out results/scoring_results.csv
+    uv run python -m src.shard local shards/manifest.json --out-dir shards/ --jobs 4   # all shards on this box
+
+A manifest splits the deck space into shards, either by seed range (in-memory
+generated batches of a root seed), by deck index range (decks of the
+counter-based generator, see data_gen.generate_deck_range) or by file range
+(deck ranges of the deck store and whole loose batch files). Every shard is scored independently into
+a versioned partial-aggregate file, and any set of partials can be merged
+into the scoring_results.csv schema. Merging refuses partials that overlap,
+so no deck is counted twice.
+'''
+import numpy as np
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import hashlib
+import argparse
+import subprocess
+
+import src.score as sc
+import src.store as store
+import src.data_gen as dg
+from src.game import GameConfig, DEFAULT_GAME
+from src.aggregate import Aggregate
+
+MANIFEST_VERSION = 1
+PARTIAL_FORMAT = 'card_game.shard_partial'
+PARTIAL_FORMAT_VERSION = 2
+PARTIAL_SUFFIX = '.partial.json'
+STREAM_STRIDE = 2**32  # coverage position of deck k of stream batch b: b * STREAM_STRIDE + k
+
+
+# manifests
+def _even_split(n: int, k: int) -> list[tuple[int, int]]:
+    '''
+    k contiguous [lo, hi) ranges covering range(n), sizes differing by at most one
+    '''
+    return [(n * s // k, n * (s + 1) // k) for s in range(k) if n * s // k < n * (s + 1) // k]
+
+def plan_seed_shards(total_decks: int, n_shards: int, batch_size: int = 10_000, seed: int = 12345,
+                     game: GameConfig = DEFAULT_GAME) -> dict:
+    '''
+    Manifest that splits total_decks in-memory generated decks (the batches
+    of score.generated_units for seed) into n_shards ranges of batches.
+    '''
+    n_batches = -(-total_decks // batch_size)
+    shards = [{'shard_id': s, 'kind': 'generated', 'first_batch': lo, 'stop_batch': hi}
+              for s, (lo, hi) in enumerate(_even_split(n_batches, n_shards))]
+    return {'manifest_id': uuid.uuid4().hex, 'version': MANIFEST_VERSION, 'kind': 'seed',
+            'seed': seed, 'batch_size': batch_size, 'total_decks': total_decks,
+            'game': game.to_dict(), 'shards': shards}
+
+def plan_counter_shards(total_decks: int, n_shards: int, seed: int = 12345, game: GameConfig = DEFAULT_GAME) -> dict:
+    '''
+    Manifest that splits decks 0..total_decks-1 of the counter-based deck
+    space of seed into n_shards deck index ranges; a worker needs only its
+    range to regenerate its decks.
+    '''
+    shards = [{'shard_id': s, 'kind': 'counter', 'start': lo, 'stop': hi}
+              for s, (lo, hi) in enumerate(_even_split(total_decks, n_shards))]
+    return {'manifest_id': uuid.uuid4().hex, 'version': MANIFEST_VERSION, 'kind': 'counter',
+            'seed': seed, 'total_decks': total_decks, 'game': game.to_dict(), 'shards': shards}
+
+def plan_file_shards(raw_data_dir: str, n_shards: int) -> dict:
+    '''
+    Manifest that splits the raw data of raw_data_dir into n_shards: the deck
+    store is cut into contiguous deck ranges, loose batch files are handed out
+    whole (round-robin), so shards get about the same number of decks.
+    '''
+    index = store.load_index(raw_data_dir)
+    files = dg.list_batch_files(raw_data_dir)
+    if not index['num_decks'] and not files:
+        raise ValueError(f'no decks found in {raw_data_dir}')
+
+    # even split of the committed decks, mapped back onto the store's deck ranges
+    ranges = store.committed_ranges(index)
+    n_stored = sum(hi - lo for lo, hi in ranges)
+    shards = [{'shard_id': s, 'kind': 'files', 'ranges': [], 'paths': []} for s in range(n_shards)]
+    for s, (first, last) in enumerate(_even_split(n_stored, n_shards)):
+        pos = 0
+        for lo, hi in ranges:
+            a, b = max(first, pos), min(last, pos + hi - lo)
+            if a < b:
+                shards[s]['ranges'].append([lo + a - pos, lo + b - pos])
+            pos += hi - lo
+    for k, path in enumerate(files):
+        shards[k % n_shards]['paths'].append(os.path.abspath(path))
+    shards = [s for s in shards if s['ranges'] or s['paths']]
+    return {'manifest_id': uuid.uuid4().hex, 'version': MANIFEST_VERSION, 'kind': 'files',
+            'raw_data_dir': os.path.abspath(raw_data_dir), 'store_id': index['store_id'],
+            'game': DEFAULT_GAME.to_dict(), 'shards': shards}
+
+def save_manifest(manifest: dict, path: str) -> None:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    sc.write_json_atomic(path, manifest)
+    print(f'[shard] Manifest {manifest["manifest_id"]} with {len(manifest["shards"])} shards saved to {path}')
+
+def load_manifest(path: str) -> dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{path}: unsupported manifest version {manifest.get("version")}')
+    return manifest
+
+def stream_source(seed: int, game: dict) -> str:
+    '''
+    Coverage source of the batch streams of a root seed (data_gen.batch_seed).
+    Deck k of batch b is the same deck whatever the batch size and whether it
+    was generated in memory or stored, so both kinds of shard record it as
+    position b * STREAM_STRIDE + k of this source.
+    '''
+    return f'stream:seed={seed}:game={json.dumps(game, sort_keys=True)}'
+
+def shard_units(manifest: dict, shard: dict) -> tuple[list[dict], list[dict]]:
+    '''
+    Work units of one shard and the coverage records that go into its
+    partial: {'source', 'start', 'stop'}, where source names a deck space
+    (the batch streams of a seed, the counter decks of a seed, a store, or
+    a file) and [start, stop) is a range of positions in it.
+    '''
+    if shard['kind'] == 'generated':
+        game = GameConfig(**manifest['game'])
+        bs, lo, hi = manifest['batch_size'], shard['first_batch'], shard['stop_batch']
+        count = min(hi * bs, manifest['total_decks']) - lo * bs
+        units = sc.generated_units(count, bs, manifest['seed'], first_batch_idx=lo, game=game)
+        source = stream_source(manifest['seed'], manifest['game'])
+        return units, [{'source': source, 'start': u['batch_idx'] * STREAM_STRIDE,
+                        'stop': u['batch_idx'] * STREAM_STRIDE + u['count']} for u in units]
+    if shard['kind'] == 'counter':
+        game = GameConfig(**manifest['game'])
+        units = sc.counter_units(shard['start'], shard['stop'], manifest['seed'], chunk_decks=None, game=game)
+        source = f'counter:seed={manifest["seed"]}:game={json.dumps(manifest["game"], sort_keys=True)}'
+        return units, [{'source': source, 'start': shard['start'], 'stop': shard['stop']}]
+
+    raw_dir = manifest['raw_data_dir']
+    units, coverage = [], []
+    if shard['ranges']:
+        index = store.load_index(raw_dir)
+        store_id = index['store_id']
+        if store_id != manifest['store_id']:
+            raise ValueError(f'the deck store in {raw_dir} changed since the manifest was made')
+        for lo, hi in shard['ranges']:
+            units.append({'kind': 'store', 'dir': raw_dir, 'store_id': store_id, 'batch_idx': None, 'start': lo, 'stop': hi})
+            # batches generated from a seed are recorded as decks of its stream, so they
+            # overlap seed shards of the same decks; batches of unknown origin by store offset
+            for b in index['batches']:
+                a, z = max(lo, b['offset']), min(hi, b['offset'] + b['count'])
+                if a >= z:
+                    continue
+                if b.get('seed') is None:
+                    coverage.append({'source': f'store:{store_id}', 'start': a, 'stop': z})
+                else:
+                    first = b['batch_idx'] * STREAM_STRIDE - b['offset']
+                    coverage.append({'source': stream_source(b['seed'], manifest['game']), 'start': first + a, 'stop': first + z})
+    for path in shard['paths']:
+        unit = {'kind': 'file', 'path': path}
+        if path.endswith('.npy'):
+            unit['start'], unit['stop'] = 0, len(np.load(path, mmap_mode='r'))
+        units.append(unit)
+        # a loose file is always scored whole
+        st = os.stat(path)
+        coverage.append({'source': f'file:{os.path.basename(path)}:{st.st_size}', 'start': 0, 'stop': 1})
+    return units, coverage
+
+
+# partials
+def partial_path(out_dir: str, manifest: dict, shard_id: int) -> str:
+    return os.path.join(out_dir, f'shard_{manifest["manifest_id"][:8]}_{shard_id:05d}{PARTIAL_SUFFIX}')
+
+def _checksum(results_json: dict) -> str:
+    return hashlib.sha256(json.dumps(results_json, sort_keys=True).encode()).hexdigest()
+
+def run_shard(manifest_path: str, shard_id: int, out_dir: str, workers: int | None = None,
+              chunk_decks: int = sc.CHUNK_DECKS, progress: bool = True, force: bool = False) -> str:
+    '''
+    Worker command: scores one shard of a manifest and writes its partial
+    aggregate (atomically) to out_dir. A shard whose partial is already there
+    is skipped unless force=True, so failed workers can simply be rerun.
+
+    Returns the path of the partial.
+    '''
+    manifest = load_manifest(manifest_path)
+    shard = next((s for s in manifest['shards'] if s['shard_id'] == shard_id), None)
+    if shard is None:
+        raise ValueError(f'shard {shard_id} is not in {manifest_path}')
+    path = partial_path(out_dir, manifest, shard_id)
+    if os.path.exists(path) and not force:
+        print(f'[shard] Shard {shard_id} already done: {path}')
+        return path
+
+    game = GameConfig(**manifest['game'])
+    units, coverage = shard_units(manifest, shard)
+    chunks = [c for unit in units for c in sc.split_unit(unit, chunk_decks)]
+
+    t0 = time.perf_counter()
+    results = Aggregate(game)
+    num_decks = 0
+    for _, chunk_results, n in sc.iter_scored_chunks(chunks, 'batch', workers, progress=progress):
+        results.merge(chunk_results['pile'])
+        num_decks += n
+
+    results_json = results.to_json()
+    partial = {
+        'format': PARTIAL_FORMAT, 'format_version': PARTIAL_FORMAT_VERSION, 'score_version': sc.SCORE_VERSION,
+        'manifest_id': manifest['manifest_id'], 'shard_id': shard_id, 'game': manifest['game'],
+        'coverage': coverage, 'num_decks': num_decks,
+        'host': socket.gethostname(), 'pid': os.getpid(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seconds': time.perf_counter() - t0,
+        'checksum': _checksum(results_json), 'results': results_json,
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    sc.write_json_atomic(path, partial)
+    print(f'[shard] Shard {shard_id}: {num_decks} decks in {partial["seconds"]:.1f}s -> {path}')
+    return path
+
+def _expand_paths(paths: list[str]) -> list[str]:
+    '''
+    Partial files, with directories expanded to the partials inside them
+    '''
+    out = []
+    for p in paths:
+        if os.path.isdir(p):
+            out += sorted(os.path.join(p, f) for f in os.listdir(p) if f.endswith(PARTIAL_SUFFIX))
+        else:
+            out.append(p)
+    return out
+
+def check_partials(partials: list[dict], manifest: dict | None = None, allow_missing: bool = False) -> None:
+    '''
+    Integrity checks before merging; raises ValueError on the first problem:
+    same format, scoring version and game; intact results (checksum);
+    deck counts that match the coverage; no shard twice; no two partials
+    covering the same decks; and, against a manifest, only its shards and
+    (unless allow_missing) all of them.
+    '''
+    if not partials:
+        raise ValueError('no partials to merge')
+    first = partials[0]
+    seen_shards = {}
+    ranges = {}
+    for p in partials:
+        name = p['_path']
+        if p.get('format') != PARTIAL_FORMAT or p.get('format_version') != PARTIAL_FORMAT_VERSION:
+            raise ValueError(f'{name}: not a version {PARTIAL_FORMAT_VERSION} shard partial')
+        if p['score_version'] != sc.SCORE_VERSION:
+            raise ValueError(f'{name}: scored with scoring version {p["score_version"]}, expected {sc.SCORE_VERSION}')
+        if p['game'] != first['game']:
+            raise ValueError(f'{name}: different game than {first["_path"]}')
+        if _checksum(p['results']) != p['checksum']:
+            raise ValueError(f'{name}: results do not match their checksum')
+        p['aggregate'] = Aggregate.from_json(p['results'])
+        scored = int(p['aggregate'].margins('cards').sum(axis=-1).max())
+        if scored != p['num_decks']:
+            raise ValueError(f'{name}: {p["num_decks"]} decks recorded but {scored} scored')
+        if manifest is not None and p['manifest_id'] != manifest['manifest_id']:
+            raise ValueError(f'{name}: belongs to manifest {p["manifest_id"]}, not {manifest["manifest_id"]}')
+
+        shard = (p['manifest_id'], p['shard_id'])
+        if shard in seen_shards:
+            raise ValueError(f'{name}: shard {p["shard_id"]} is also in {seen_shards[shard]}')
+        seen_shards[shard] = name
+        for c in p['coverage']:
+            ranges.setdefault(c['source'], []).append((c['start'], c['stop'], name))
+
+    # the same decks must not be in two partials, whatever manifest (or kind of shard) they came from
+    for source, spans in ranges.items():
+        spans.sort()
+        for (lo1, hi1, n1), (lo2, hi2, n2) in zip(spans, spans[1:]):
+            if lo2 < hi1:
+                raise ValueError(f'{n1} and {n2} both cover [{lo2}, {min(hi1, hi2)}) of {source}')
+
+    if manifest is not None:
+        missing = sorted({s['shard_id'] for s in manifest['shards']} - {p['shard_id'] for p in partials})
+        if missing and not allow_missing:
+            raise ValueError(f'{len(missing)} shards of the manifest have no partial: {missing[:10]}')
+        if missing:
+            print(f'[shard] Warning: merging without {len(missing)} shards: {missing[:10]}')
+
+def merge_shards(paths: list[str], output_csv_path: str, manifest_path: str | None = None,
+                 allow_missing: bool = False) -> int:
+    '''
+    Merge command: combines shard partials (files or directories of them)
+    into one CSV with the scoring_results.csv schema, after check_partials.
+
+    Returns the number of decks merged.
+    '''
+    partials = []
+    for path in _expand_paths(paths):
+        with open(path) as f:
+            partial = json.load(f)
+        partial['_path'] = path
+        partials.append(partial)
+    manifest = load_manifest(manifest_path) if manifest_path else None
+    check_partials(partials, manifest, allow_missing)
+
+    game = GameConfig(**partials[0]['game'])
+    results = Aggregate(game)
+    total_decks = 0
+    for p in partials:
+        results.merge(p['aggregate'])
+        total_decks += p['num_decks']
+
+    if os.path.dirname(output_csv_path):
+        os.makedirs(os.path.dirname(output_csv_path), exist_ok=True)
+    sc.write_results_csv(results, output_csv_path)
+    print(f'[shard] Merged {len(partials)} partials, {total_decks} decks -> {output_csv_path}')
+    return total_decks
+
+def run_local(manifest_path: str, out_dir: str, jobs: int = 2, workers_per_job: int = 1) -> None:
+    '''
+    Runs every shard of a manifest as its own 'work' process on this machine,
+    jobs at a time, the same way separate hosts would.
+    '''
+    manifest = load_manifest(manifest_path)
+    pending = [s['shard_id'] for s in manifest['shards']]
+    running = []
+    while pending or running:
+        while pending and len(running) < jobs:
+            shard_id = pending.pop(0)
+            cmd = [sys.executable, '-m', 'src.shard', 'work', manifest_path, str(shard_id),
+                   '--out-dir', out_dir, '--workers', str(workers_per_job), '--no-progress']
+            running.append((shard_id, subprocess.Popen(cmd)))
+        time.sleep(0.1)
+        for shard_id, proc in list(running):
+            if proc.poll() is not None:
+                running.remove((shard_id, proc))
+                if proc.returncode != 0:
+                    raise RuntimeError(f'shard {shard_id} failed with exit code {proc.returncode}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded scoring: plan shards, score one shard, merge partials.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('plan', help='Write a manifest that splits the decks into shards.')
+    p.add_argument('--shards', type=int, required=True, help='Number of shards.')
+    p.add_argument('--out', required=True, help='Manifest path.')
+    space = p.add_mutually_exclusive_group(required=True)
+    space.add_argument('--decks', type=int, help='Shard by seed range: N decks generated in memory.')
+    space.add_argument('--counter-decks', type=int, metavar='N',
+                       help='Shard by deck index range: decks 0..N-1 of the counter-based generator.')
+    space.add_argument('--raw-dir', help='Shard by file range: the deck store and batch files of this directory.')
+    p.add_argument('--batch-size', type=int, default=10_000, help='Decks per generated batch (default: %(default)s).')
+    p.add_argument('--seed', type=int, default=12345, help='Root seed of the generated decks (default: %(default)s).')
+    p.add_argument('--seq-len', type=int, default=DEFAULT_GAME.seq_len, help='Cards per player sequence (seed and counter shards).')
+    p.add_argument('--colors', type=int, default=DEFAULT_GAME.n_colors, help='Number of card colors (seed and counter shards).')
+    p.add_argument('--cards-per-color', type=int, default=DEFAULT_GAME.cards_per_color,
+                   help='Cards of each color per deck (seed and counter shards).')
+    p.add_argument('--shoe-decks', type=int, default=DEFAULT_GAME.n_decks, help='Decks shuffled into one shoe (seed and counter shards).')
+
+    p = sub.add_parser('work', help='Score one shard and write its partial aggregate.')
+    p.add_argument('manifest')
+    p.add_argument('shard_id', type=int)
+    p.add_argument('--out-dir', required=True, help='Shared directory for the partials.')
+    p.add_argument('--workers', type=int, help='Scoring processes on this host (default: all cores).')
+    p.add_argument('--chunk-decks', type=int, default=sc.CHUNK_DECKS, help='Decks per scoring task.')
+    p.add_argument('--no-progress', action='store_true')
+    p.add_argument('--force', action='store_true', help='Rescore even if the partial exists.')
+
+    p = sub.add_parser('merge', help='Merge partials into a scoring CSV.')
+    p.add_argument('partials', nargs='+', help='Partial files or directories of them.')
+    p.add_argument('--out', required=True, help='Output CSV path.')
+    p.add_argument('--manifest', help='Only accept partials of this manifest and require all of its shards.')
+    p.add_argument('--allow-missing', action='store_true', help='With --manifest: merge even if shards are missing.')
+
+    p = sub.add_parser('local', help='Run all shards of a manifest as local worker processes, then merge.')
+    p.add_argument('manifest')
+    p.add_argument('--out-dir', required=True)
+    p.add_argument('--jobs', type=int, default=2, help='Worker processes at a time (default: %(default)s).')
+    p.add_argument('--out', help='Merged CSV path (default: <out-dir>/scoring_results.csv).')
+
+    args = parser.parse_args()
+    if args.command == 'plan':
+        try:
+            game = GameConfig(seq_len=args.seq_len, n_colors=args.colors, cards_per_color=args.cards_per_color,
+                              n_decks=args.shoe_decks)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.shards < 1 or args.batch_size < 1:
+            parser.error('--shards and --batch-size must be at least 1')
+        if args.raw_dir is not None and game != DEFAULT_GAME:
+            parser.error('the deck store holds standard-game decks; --seq-len, --colors, --cards-per-color and '
+                         '--shoe-decks apply to --decks and --counter-decks')
+        if args.decks is not None:
+            if args.decks < 1:
+                parser.error('--decks must be at least 1')
+            manifest = plan_seed_shards(args.decks, args.shards, args.batch_size, args.seed, game)
+        elif args.counter_decks is not None:
+            if args.counter_decks < 1:
+                parser.error('--counter-decks must be at least 1')
+            manifest = plan_counter_shards(args.counter_decks, args.shards, args.seed, game)
+        else:
+            manifest = plan_file_shards(args.raw_dir, args.shards)
+        save_manifest(manifest, args.out)
+    elif args.command == 'work':
+        run_shard(args.manifest, args.shard_id, args.out_dir, args.workers, args.chunk_decks,
+                  progress=not args.no_progress, force=args.force)
+    elif args.command == 'merge':
+        merge_shards(args.partials, args.out, args.manifest, args.allow_missing)
+    elif args.command == 'local':
+        run_local(args.manifest, args.out_dir, args.jobs)
+        merge_shards([args.out_dir], args.out or os.path.join(args.out_dir, 'scoring_results.csv'), args.manifest)
@@ -0,0 +1,173 @@
+import numpy as np
+import os
+import json
+import uuid
+
+STORE_FILE = 'decks.u64'
+INDEX_FILE = 'decks_index.json'
+STORE_DTYPE = np.dtype('<u8')
+
+
+def store_path(store_dir: str) -> str:
+    '''
+    Path of the packed deck data file (raw little-endian uint64, one per deck)
+    '''
+    return os.path.join(store_dir, STORE_FILE)
+
+def index_path(store_dir: str) -> str:
+    '''
+    Path of the store index (batch offsets, counts and seeds)
+    '''
+    return os.path.join(store_dir, INDEX_FILE)
+
+def has_store(store_dir: str) -> bool:
+    '''
+    True if store_dir holds a deck store
+    '''
+    return os.path.exists(index_path(store_dir))
+
+def load_index(store_dir: str) -> dict:
+    '''
+    Load the store index, or an empty one if there is no store yet:
+    {'store_id': str, 'num_decks': int,
+     'batches': [{'batch_idx', 'offset', 'count', 'seed'}, ...]}
+    '''
+    if not has_store(store_dir):
+        return {'store_id': None, 'num_decks': 0, 'batches': []}
+    with open(index_path(store_dir)) as f:
+        return json.load(f)
+
+def _write_index(store_dir: str, index: dict) -> None:
+    tmp = index_path(store_dir) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, index_path(store_dir))
+
+def create_store(store_dir: str) -> dict:
+    '''
+    Create an empty store in store_dir, replacing any existing one.
+    Each store gets a fresh id so cached partial aggregates of an older
+    store are never reused.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    open(store_path(store_dir), 'wb').close()
+    index = {'store_id': uuid.uuid4().hex, 'num_decks': 0, 'batches': []}
+    _write_index(store_dir, index)
+    return index
+
+def reserve_batches(store_dir: str, batches: list[tuple[int, int, int | None]]) -> list[dict]:
+    '''
+    Reserve space at the end of the store for new batches, given as
+    (batch_idx, count, seed), so they can be written in parallel with
+    write_range. The batches only become part of the store once
+    commit_batches adds them to the index; until then a crash leaves the
+    store at its previous state (trailing bytes are truncated next time).
+
+    Returns the index entries (with offsets) of the reserved batches.
+    '''
+    index = load_index(store_dir) if has_store(store_dir) else create_store(store_dir)
+    existing = {b['batch_idx'] for b in index['batches']}
+    offset = index['num_decks']
+    entries = []
+    for batch_idx, count, seed in batches:
+        if batch_idx in existing:
+            raise ValueError(f'batch {batch_idx} is already in the store at {store_dir}')
+        entries.append({'batch_idx': int(batch_idx), 'offset': int(offset), 'count': int(count), 'seed': seed})
+        offset += count
+
+    with open(store_path(store_dir), 'r+b') as f:
+        f.truncate(offset * STORE_DTYPE.itemsize)
+    return entries
+
+def write_range(store_dir: str, start: int, packed: np.ndarray) -> None:
+    '''
+    Write packed decks into reserved store space starting at deck start
+    '''
+    if len(packed) == 0:
+        return
+    out = np.memmap(store_path(store_dir), dtype=STORE_DTYPE, mode='r+',
+                    offset=start * STORE_DTYPE.itemsize, shape=(len(packed),))
+    out[:] = packed
+    out.flush()
+    del out
+
+def commit_batches(store_dir: str, entries: list[dict]) -> None:
+    '''
+    Add reserved and written batches to the store index.
+    '''
+    index = load_index(store_dir)
+    index['batches'].extend(entries)
+    index['num_decks'] = max([index['num_decks']] + [e['offset'] + e['count'] for e in entries])
+    _write_index(store_dir, index)
+
+def append_batch(store_dir: str, packed: np.ndarray, batch_idx: int, seed: int | None = None) -> dict:
+    '''
+    Append one batch of packed decks (see data_gen.pack_decks) to the store.
+
+    Returns the index entry of the new batch.
+    '''
+    entry, = reserve_batches(store_dir, [(batch_idx, len(packed), seed)])
+    write_range(store_dir, entry['offset'], np.asarray(packed, dtype=STORE_DTYPE))
+    commit_batches(store_dir, [entry])
+    return entry
+
+def committed_ranges(index: dict) -> list[tuple[int, int]]:
+    '''
+    Sorted, coalesced [start, stop) deck ranges of the batches in the index.
+    A run that was interrupted and resumed can leave reserved but never
+    committed space between batches; that space is not part of any range.
+    '''
+    ranges = []
+    for b in sorted(index['batches'], key=lambda b: b['offset']):
+        lo, hi = b['offset'], b['offset'] + b['count']
+        if ranges and ranges[-1][1] == lo:
+            ranges[-1] = (ranges[-1][0], hi)
+        else:
+            ranges.append((lo, hi))
+    return ranges
+
+def read_range(store_dir: str, start: int, stop: int) -> np.ndarray:
+    '''
+    Zero-copy, read-only view of packed decks [start, stop) via np.memmap
+    '''
+    if stop <= start:
+        return np.empty(0, dtype=STORE_DTYPE)
+    return np.memmap(store_path(store_dir), dtype=STORE_DTYPE, mode='r',
+                     offset=start * STORE_DTYPE.itemsize, shape=(stop - start,))
+
+def migrate_batch_files(raw_dir: str, remove: bool = False) -> int:
+    '''
+    One-shot migration of loose batch files (.npz or packed .npy) in raw_dir
+    into the deck store of the same directory, in batch index order.
+    A file whose decks are already in the store (same batch index, same
+    decks) is not added again. A file whose batch index is taken by other
+    decks (e.g. a store generated next to older batch files) is added under
+    a new batch index. With remove=True the files (and their partial
+    aggregates) are deleted once their decks are in the store.
+
+    Returns the number of decks migrated.
+    '''
+    import src.data_gen as dg
+
+    existing = {b['batch_idx']: b for b in load_index(raw_dir)['batches']}
+    n_decks = 0
+    for path in dg.list_batch_files(raw_dir):
+        name = os.path.basename(path)
+        batch_idx = dg.batch_index_of(path)
+        packed = np.load(path) if path.endswith('.npy') else dg.pack_decks(np.load(path)['decks'])
+        stored = existing.get(batch_idx)
+        if stored is not None and stored['count'] == len(packed) and \
+                np.array_equal(read_range(raw_dir, stored['offset'], stored['offset'] + stored['count']), packed):
+            print(f'[store] {name}: already in the store as batch {batch_idx}')
+        else:
+            if stored is not None:
+                new_idx = dg.next_batch_index(raw_dir)
+                print(f'[store] {name}: batch {batch_idx} of the store holds other decks, migrated as batch {new_idx}')
+                batch_idx = new_idx
+            existing[batch_idx] = append_batch(raw_dir, packed, batch_idx)
+            n_decks += len(packed)
+        if remove:
+            os.remove(path)
+            if os.path.exists(path + '.partial.json'):
+                os.remove(path + '.partial.json')
+    return n_decks
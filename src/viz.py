@@ -1,16 +1,23 @@
 import os
+import json
+import time
+import hashlib
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import matplotlib.patches as patches
-from matplotlib.ticker import PercentFormatter
 
 from typing import List
+from multiprocessing import Pool, current_process
 
-SEQUENCES_BINARY: List[str] = ['000','001','010','011','100','101','110','111']
-SEQUENCES_MAPPED: List[str] = ['BBB', 'BBR', 'BRB', 'BRR', 'RBB', 'RBR', 'RRB', 'RRR']
+from src.metrics import maybe_stage
+from src.game import DEFAULT_GAME, sequence_label
+from src.aggregate import Aggregate, load_aggregate
+
+SEQUENCES_BINARY: List[str] = DEFAULT_GAME.players()
+SEQUENCES_MAPPED: List[str] = [sequence_label(p) for p in SEQUENCES_BINARY]
 SEQUENCE_MAP = dict(zip(SEQUENCES_BINARY, SEQUENCES_MAPPED))
+ANNOTATE_MAX_PLAYERS = 16  # larger matrices are drawn without cell text
+RENDER_VERSION = 1  # bump when plot_heatmap changes, so unchanged inputs are redrawn once
+FINGERPRINT_FILE = 'heatmaps_fingerprint.json'
 
 
 def ensure_dir(path: str):
@@ -22,23 +29,33 @@ def ensure_dir(path: str):
 
 
 
-def make_annotations(win_df: pd.DataFrame, tie_rate_df: pd.DataFrame) -> np.ndarray:
+def rate_matrix(agg: Aggregate, counter: str) -> pd.DataFrame:
     '''
-    Creates annotation strings showing win % and tie %.
+    players x players rate matrix of one counter of the aggregate, player1
+    as rows and player2 as columns, labeled with the color letters; pairs
+    without decks (the diagonal) are NaN.
     '''
-    win_np = win_df.to_numpy()
-    tie_rate_np = tie_rate_df.to_numpy()
-    ann = np.empty(win_np.shape, dtype=object)
+    labels = [sequence_label(p) for p in agg.game.players()]
+    return pd.DataFrame(agg.rates(counter), index=labels, columns=labels)
 
-    for i in range(win_np.shape[0]):
-        for j in range(win_np.shape[1]):
-            if np.isnan(win_np[i, j]):
-                ann[i, j] = ''
-            else:
-                win_val = int(np.rint(win_np[i, j] * 100))
-                tie_val = int(np.rint(tie_rate_np[i, j] * 100))
-                ann[i, j] = f'{win_val} ({tie_val})'
-    return ann
+def make_annotations(win_df: pd.DataFrame | np.ndarray, tie_rate_df: pd.DataFrame | np.ndarray,
+                     ci_df: pd.DataFrame | np.ndarray | None = None) -> np.ndarray:
+    '''
+    Creates annotation strings showing win % and tie %, plus the 95%
+    interval of the win % on a second line if ci_df is given.
+    '''
+    win_np = np.asarray(win_df, dtype=float)
+    tie_rate_np = np.asarray(tie_rate_df, dtype=float)
+    empty = np.isnan(win_np)
+    # whole-matrix string operations; NaN cells are formatted as 0 and blanked below
+    win_val = np.rint(np.nan_to_num(win_np) * 100).astype(np.int64)
+    tie_val = np.rint(np.nan_to_num(tie_rate_np) * 100).astype(np.int64)
+    ann = np.char.add(np.char.add(win_val.astype(str), ' ('), np.char.add(tie_val.astype(str), ')'))
+    if ci_df is not None:
+        ci_np = np.asarray(ci_df, dtype=float)
+        ci_text = np.char.mod('\n±%.1f', np.nan_to_num(ci_np) * 100)
+        ann = np.char.add(ann, np.where(np.isnan(ci_np), '', ci_text))
+    return np.where(empty, '', ann).astype(object)
 
 def plot_heatmap(win_df: pd.DataFrame,
                  ann: np.ndarray,
@@ -48,21 +65,35 @@ def plot_heatmap(win_df: pd.DataFrame,
                  cmap: str = 'Blues') -> None:
     '''
     Generates and saves a styled heatmap plot. Used gemini and ChatGPT to check plotting specifics.
+    Matrices larger than the standard 8x8 get a bigger figure and smaller
+    text; above ANNOTATE_MAX_PLAYERS players the cells are not annotated.
     '''
+    # plotting libraries are only imported when a figure is actually drawn
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import matplotlib.patches as patches
+
     ensure_dir(os.path.dirname(out_png))
-    plt.figure(figsize=(9, 8))
+    n = len(win_df)
+    scale = max(1.0, n / 8)
+    annotate = n <= ANNOTATE_MAX_PLAYERS
+    fontsize = (8 if any('\n' in a for a in ann.ravel()) else 9) / scale ** 0.5
+    plt.figure(figsize=(9 * scale ** 0.75, 8 * scale ** 0.75))
     ax = sns.heatmap(
         win_df,
         vmin=0, vmax=1,
         cmap=cmap,
         square=True,
-        linewidths=0.5,
+        linewidths=0.5 if n <= 16 else 0,
         linecolor='white',
         cbar_kws={'shrink': 0.9},
-        annot=ann,
+        annot=ann if annotate else False,
         fmt='',
-        annot_kws={'fontsize': 9}
+        annot_kws={'fontsize': fontsize},
+        xticklabels=True, yticklabels=True,
     )
+    if n > 8:
+        ax.tick_params(labelsize=max(5, 10 / scale ** 0.5))
 
     ax.set_xlabel("My choice", fontsize=12, labelpad=10, weight='bold')
     ax.set_ylabel("Opponent choice", fontsize=12, labelpad=10, weight='bold')
@@ -76,62 +107,108 @@ def plot_heatmap(win_df: pd.DataFrame,
             (j, i), 1, 1,
             fill=False,
             edgecolor='black',
-            linewidth=2.2
+            linewidth=2.2 / scale ** 0.5
         )
         ax.add_patch(rect)
 
     plt.tight_layout()
-    plt.savefig(out_png, bbox_inches='tight', dpi=300)
+    plt.savefig(out_png, bbox_inches='tight', dpi=300 if n <= 16 else 150)
     plt.close()
     print(f"[viz] Saved heatmap to {os.path.abspath(out_png)}")
 
-def run_visualization(csv_path: str, outdir: str, total_decks: int):
+def render_fingerprint(win_df: pd.DataFrame, ann: np.ndarray, title: str, total_decks: int, cmap: str = 'Blues') -> str:
+    '''
+    Hash of everything a heatmap is drawn from: the rate matrix, the cell
+    text, the title, the deck count, the colormap and RENDER_VERSION
+    '''
+    h = hashlib.sha256(f'v{RENDER_VERSION}:{title}:{total_decks}:{cmap}:{list(win_df.index)}'.encode())
+    h.update(np.ascontiguousarray(win_df.to_numpy(dtype=float)).tobytes())
+    h.update('\x00'.join(ann.ravel().tolist()).encode())
+    return h.hexdigest()
+
+def _load_fingerprints(outdir: str) -> dict:
+    try:
+        with open(os.path.join(outdir, FINGERPRINT_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _plot_job(job: dict) -> float:
+    '''
+    Pool worker: draws one heatmap (keyword arguments of plot_heatmap) and
+    returns the seconds it took
+    '''
+    t0 = time.perf_counter()
+    plot_heatmap(**job)
+    return time.perf_counter() - t0
+
+def render_aggregate(agg: Aggregate, outdir: str, total_decks: int, metrics=None,
+                     parallel: bool = True, force: bool = False) -> list[str]:
+    '''
+    Draws the cards and tricks heatmaps of a scoring aggregate into outdir,
+    without going through the CSV. Matrices and annotations are built with
+    whole-array operations. A heatmap whose inputs have the same fingerprint
+    as when its PNG was last drawn (see render_fingerprint, kept in
+    outdir/heatmaps_fingerprint.json) is not redrawn unless force; the
+    others are drawn in parallel processes unless parallel is False or this
+    is a daemonic process (a Pool worker), which cannot start children.
+    metrics: optional metrics.Metrics, receives 'visualization/*' sub-stages.
+
+    Returns the paths of the heatmaps that were drawn.
+    '''
+    with maybe_stage(metrics, 'visualization/build_matrices'):
+        figures = []
+        for rule, name in (('cards', 'Cards'), ('tricks', 'Tricks')):
+            # n x n win rates (NaN on the diagonal) and their annotations with the 95% half-widths
+            wins = rate_matrix(agg, f'{rule}_p2_wins')
+            ann = make_annotations(wins, agg.rates(f'{rule}_ties'), agg.ci(f'{rule}_p2_wins'))
+            figures.append((rule, dict(win_df=wins, ann=ann, title=f'My Chance of Winning(Draw) by {name}',
+                                       out_png=os.path.join(outdir, f'heatmap_by_{rule}.png'), total_decks=total_decks)))
+
+    fingerprints = _load_fingerprints(outdir)
+    todo = []
+    for rule, job in figures:
+        fp = render_fingerprint(job['win_df'], job['ann'], job['title'], total_decks)
+        name = os.path.basename(job['out_png'])
+        if not force and fingerprints.get(name) == fp and os.path.exists(job['out_png']):
+            print(f"[viz] {name} is up to date, not redrawn")
+            continue
+        todo.append((rule, job, name, fp))
+    if metrics is not None:
+        metrics.add('visualization/skipped', figures=len(figures) - len(todo))
+    if not todo:
+        return []
+
+    ensure_dir(outdir)
+    jobs = [job for _, job, _, _ in todo]
+    with maybe_stage(metrics, 'visualization/render'):
+        if parallel and len(jobs) > 1 and not current_process().daemon:
+            with Pool(processes=len(jobs)) as pool:
+                seconds = pool.map(_plot_job, jobs)
+        else:
+            seconds = [_plot_job(job) for job in jobs]
+    for (rule, _, name, fp), t in zip(todo, seconds):
+        fingerprints[name] = fp
+        if metrics is not None:
+            metrics.add(f'visualization/render_{rule}', seconds=t)
+    tmp = os.path.join(outdir, f'{FINGERPRINT_FILE}.tmp{os.getpid()}')
+    with open(tmp, 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+    os.replace(tmp, os.path.join(outdir, FINGERPRINT_FILE))
+    return [job['out_png'] for job in jobs]
+
+def run_visualization(csv_path: str, outdir: str, total_decks: int, metrics=None,
+                      parallel: bool = True, force: bool = False):
     '''
-    Main function to read scoring CSV and generate heatmap visualizations.
+    Main function to read the aggregate behind a scoring CSV (see
+    aggregate.load_aggregate) and generate heatmap visualizations with
+    render_aggregate (parallel, force: see there).
+    metrics: optional metrics.Metrics, receives 'visualization/*' sub-stages.
     '''
     if not os.path.exists(csv_path):
         print(f'Error: CSV file not found at {csv_path}')
         return
 
-    df = pd.read_csv(csv_path, dtype={'player1': str, 'player2': str})
-
-    # Initialize 8x8 matrices for win and tie rates
-    cards_wins = pd.DataFrame(np.nan, index=SEQUENCES_BINARY, columns=SEQUENCES_BINARY)
-    tricks_wins = pd.DataFrame(np.nan, index=SEQUENCES_BINARY, columns=SEQUENCES_BINARY)
-    cards_ties = pd.DataFrame(np.nan, index=SEQUENCES_BINARY, columns=SEQUENCES_BINARY)
-    tricks_ties = pd.DataFrame(np.nan, index=SEQUENCES_BINARY, columns=SEQUENCES_BINARY)
-
-    # Populate matrices from the CSV data
-    for _, row in df.iterrows():
-        p1 = row['player1']
-        p2 = row['player2']
-        cards_wins.loc[p1, p2] = row['cards_p2_win_rate']
-        tricks_wins.loc[p1, p2] = row['tricks_p2_win_rate']
-        cards_ties.loc[p1, p2] = row['cards_tie_rate']
-        tricks_ties.loc[p1, p2] = row['tricks_tie_rate']
-
-    cards_wins.rename(index=SEQUENCE_MAP, columns=SEQUENCE_MAP, inplace=True)
-    tricks_wins.rename(index=SEQUENCE_MAP, columns=SEQUENCE_MAP, inplace=True)
-    cards_ties.rename(index=SEQUENCE_MAP, columns=SEQUENCE_MAP, inplace=True)
-    tricks_ties.rename(index=SEQUENCE_MAP, columns=SEQUENCE_MAP, inplace=True)
-
-    # Reorder rows for display
-    cards_wins_disp = cards_wins
-    tricks_wins_disp = tricks_wins
-    cards_ties_disp = cards_ties
-    tricks_ties_disp = tricks_ties
-
-    # Create annotation labels
-    ann_cards = make_annotations(cards_wins_disp, cards_ties_disp)
-    ann_tricks = make_annotations(tricks_wins_disp, tricks_ties_disp)
-
-    # Generate and save plots
-    plot_heatmap(cards_wins_disp, ann_cards,
-                 title='My Chance of Winning(Draw) by Cards',
-                 out_png=os.path.join(outdir, 'heatmap_by_cards.png'),
-                 total_decks=total_decks)
-
-    plot_heatmap(tricks_wins_disp, ann_tricks,
-                 title='My Chance of Winning(Draw) by Tricks',
-                 out_png=os.path.join(outdir, 'heatmap_by_tricks.png'),
-                 total_decks=total_decks)
+    with maybe_stage(metrics, 'visualization/read_csv'):
+        agg = load_aggregate(csv_path)
+    return render_aggregate(agg, outdir, total_decks, metrics, parallel, force)
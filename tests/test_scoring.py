@@ -0,0 +1,143 @@
+'''
+Equivalence checks behind the scoring engines, the packed deck format, the
+exact dynamic program and the counter-based deck space. Run with
+`uv run --with pytest pytest` from the repository root.
+'''
+import itertools
+
+import numpy as np
+import pytest
+
+import src.data_gen as dg
+import src.score as sc
+from src.aggregate import wilson_halfwidth
+from src.exact import _exact_pair, exact_results
+from src.game import GameConfig, DEFAULT_GAME
+
+RULES = tuple(sc.SCORING_RULES)
+GAMES = [
+    (DEFAULT_GAME, 200),
+    (GameConfig(seq_len=4), 60),
+    (GameConfig(n_colors=3, cards_per_color=10), 30),
+    (GameConfig(cards_per_color=13, n_decks=2), 60),
+]
+
+
+def reference_scores(windows: np.ndarray, pairs, game: GameConfig) -> tuple[np.ndarray, ...]:
+    '''
+    score_pair_rules (window by window) on every deck and pair:
+    (p1_cards, p2_cards) of shape (rules, N, P) and the tricks of shape (N, P)
+    '''
+    p1c = np.zeros((len(RULES), len(windows), len(pairs)), dtype=np.int64)
+    p2c = np.zeros_like(p1c)
+    p1t = np.zeros((len(windows), len(pairs)), dtype=np.int64)
+    p2t = np.zeros_like(p1t)
+    for d, win in enumerate(windows.tolist()):
+        for k, (i, j) in enumerate(pairs):
+            p1c[:, d, k], p2c[:, d, k], p1t[d, k], p2t[d, k] = sc.score_pair_rules(win, i, j, game.seq_len, RULES)
+    return p1c, p2c, p1t, p2t
+
+
+@pytest.mark.parametrize('game, n_decks', GAMES, ids=lambda g: str(g))
+def test_engines_match_window_kernel(game, n_decks):
+    decks = dg.generate_decks(n_decks, dg.batch_seed(7, 0), game)
+    windows = sc.deck_to_windows(decks, game)
+    pairs = sc.get_pairs(game)
+    p1c, p2c, p1t, p2t = reference_scores(windows, pairs, game)
+
+    # batch engine: next-occurrence tables, every deck and pair at once
+    cards, t1, t2 = sc.score_windows_rules(windows, [i for i, _ in pairs], [j for _, j in pairs], game.seq_len, RULES)
+    for r, rule in enumerate(RULES):
+        np.testing.assert_array_equal(cards[rule][0], p1c[r])
+        np.testing.assert_array_equal(cards[rule][1], p2c[r])
+    np.testing.assert_array_equal(t1, p1t)
+    np.testing.assert_array_equal(t2, p2t)
+
+    # per-deck jumps and both engines' aggregates
+    expected = sc.aggregate_rules({rule: (p1c[r], p2c[r]) for r, rule in enumerate(RULES)}, p1t, p2t, pairs, game)
+    for rule, agg in sc.score_decks_rules(decks, pairs, game, RULES).items():
+        np.testing.assert_array_equal(agg.data, expected[rule].data)
+    for rule, agg in sc.score_windows_all_rules(windows, pairs, game, RULES).items():
+        np.testing.assert_array_equal(agg.data, expected[rule].data)
+
+
+def test_table_slices_match_one_table(monkeypatch):
+    decks = dg.generate_decks(100, dg.batch_seed(3, 1))
+    windows = sc.deck_to_windows(decks)
+    pairs = sc.get_pairs()
+    whole = sc.score_windows_all_rules(windows, pairs, rules=RULES)
+    # tables of about 7 decks at a time
+    monkeypatch.setattr(sc, 'TABLE_MAX_BYTES', 7 * 51 * 8 * 2)
+    for rule, agg in sc.score_windows_all_rules(windows, pairs, rules=RULES).items():
+        np.testing.assert_array_equal(agg.data, whole[rule].data)
+
+
+@pytest.mark.parametrize('game', [DEFAULT_GAME, GameConfig(seq_len=4), GameConfig(cards_per_color=16, n_decks=2)],
+                         ids=lambda g: str(g))
+def test_packed_round_trip(game):
+    decks = dg.generate_decks(50, dg.batch_seed(11, 0), game)
+    packed = dg.pack_decks(decks)
+    assert packed.dtype == np.uint64
+    np.testing.assert_array_equal(dg.unpack_decks(packed, game.deck_size), decks)
+    np.testing.assert_array_equal(sc.packed_to_windows(packed, game), sc.deck_to_windows(decks, game))
+
+
+def enumerate_decks(n_zero: int, n_one: int) -> np.ndarray:
+    '''
+    Every arrangement of n_zero zeros and n_one ones, one per row
+    '''
+    n = n_zero + n_one
+    decks = np.zeros((sum(1 for _ in itertools.combinations(range(n), n_one)), n), dtype=np.uint8)
+    for d, ones in enumerate(itertools.combinations(range(n), n_one)):
+        decks[d, list(ones)] = 1
+    return decks
+
+
+@pytest.mark.parametrize('n_zero, n_one', [(4, 4), (3, 6), (6, 5)])
+def test_exact_pair_matches_enumeration(n_zero, n_one):
+    decks = enumerate_decks(n_zero, n_one)
+    windows = sc.deck_to_windows(decks)
+    n = n_zero + n_one
+    for i, j in itertools.permutations(range(8), 2):
+        p1c, p2c, p1t, p2t = (np.array(v) for v in zip(*(sc.score_pair_on_windows(w, i, j) for w in windows)))
+        for by_cards, a, b, max_margin in ((True, p1c, p2c, n), (False, p1t, p2t, n // 3)):
+            margins, p1_total, p2_total = _exact_pair(i, j, by_cards, n_zero, n_one)
+            expected = np.bincount(a - b + max_margin, minlength=2 * max_margin + 1)
+            np.testing.assert_array_equal(margins, expected)
+            assert (p1_total, p2_total) == (a.sum(), b.sum())
+
+
+def test_exact_results_match_enumeration():
+    results, total_decks = exact_results(4, 4)
+    decks = enumerate_decks(4, 4)
+    assert total_decks == len(decks)
+    np.testing.assert_array_equal(results.data, sc.score_decks_batch(decks, GameConfig(cards_per_color=4)).data)
+
+
+@pytest.mark.parametrize('game', [DEFAULT_GAME, GameConfig(n_colors=3, cards_per_color=10)], ids=lambda g: str(g))
+def test_deck_range_slices_are_consistent(game):
+    whole = dg.generate_deck_range(0, 40, seed=5, game=game)
+    assert whole.shape == (40, game.deck_size)
+    np.testing.assert_array_equal(np.concatenate([dg.generate_deck_range(0, 13, 5, game),
+                                                  dg.generate_deck_range(13, 40, 5, game)]), whole)
+    np.testing.assert_array_equal(dg.generate_deck_range(17, 23, 5, game), whole[17:23])
+    for k in (0, 21, 39):
+        np.testing.assert_array_equal(dg.generate_deck(k, 5, game), whole[k])
+    # every deck is a shuffle of the base shoe
+    per_color = game.cards_per_color * game.n_decks
+    assert all((np.bincount(deck, minlength=game.n_colors) == per_color).all() for deck in whole)
+    with pytest.raises(ValueError):
+        dg.generate_deck_range(5, 4)
+
+
+def test_pooled_symmetry_keeps_decks():
+    decks = dg.generate_decks(300, dg.batch_seed(2, 0))
+    agg = sc.score_decks_batch(decks)
+    pooled = sc.apply_symmetry(agg, 'double')
+    np.testing.assert_array_equal(pooled['decks'], agg['decks'])
+    np.testing.assert_array_equal(pooled.samples()[agg['decks'] > 0], 2 * 300)
+    # the pooled rate is the mean of the pair and its mirror, the interval is over the 300 decks
+    i, j = 1, 6
+    rate = pooled.rates('cards_p1_wins')[i, j]
+    assert rate == pytest.approx((agg.rates('cards_p1_wins')[i, j] + agg.rates('cards_p1_wins')[6, 1]) / 2)
+    assert pooled.ci('cards_p1_wins')[i, j] == pytest.approx(float(wilson_halfwidth(rate * 300, 300)))